@@ -0,0 +1,176 @@
+'''
+Benchmark the detector over a corpus of clean, scam, link-heavy and adversarial messages
+
+Run from the repository root: python -m benchmarks.detector [--save FILE] [--compare FILE]
+'''
+from argparse import ArgumentParser
+from asyncio import run
+from dataclasses import dataclass, field
+from itertools import count
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+from library import db, detector
+from library.scheduler import percentile
+from library.urls import Shared, slashes
+
+CORPUS = Path(__file__).with_name('corpus.json')
+GUILD = 0
+REGRESSION = 1.1 # slower than the baseline by more than 10%
+
+@dataclass
+class Message:
+    '''A stand-in for the parts of discord.Message the detector reads'''
+    id : int
+    content : str
+    embeds : list
+    guild : SimpleNamespace = field(default_factory=lambda: SimpleNamespace(id=GUILD))
+    author : SimpleNamespace = field(default_factory=lambda: SimpleNamespace(id=1))
+    stickers : list = field(default_factory=list)
+
+async def redirect(urls, budget=8): # pylint: disable=unused-argument
+    '''Resolve no redirects, without the network'''
+    return set(urls), True
+
+async def unsafe(urls): # pylint: disable=unused-argument
+    '''Find no URL unsafe, without the network'''
+    return False
+
+def load(ids):
+    '''Load and return the corpus as fake messages by category'''
+    corpus = {}
+
+    for entry in json.loads(CORPUS.read_text(encoding='utf-8')):
+        embeds = [SimpleNamespace(provider=SimpleNamespace(name=name)) for name in entry['embeds']]
+        corpus.setdefault(entry['category'], []).append(
+            Message(next(ids), entry['content'], embeds, author=SimpleNamespace(id=next(ids)))
+        )
+
+    return corpus
+
+async def measure(function, arguments, rounds):
+    '''Return the latency of every call of the function on each argument over the rounds'''
+    latencies = []
+
+    for argument in arguments: # warm up
+        await function(argument)
+
+    for _ in range(rounds):
+        for argument in arguments:
+            start = perf_counter()
+            await function(argument)
+            latencies.append(perf_counter() - start)
+
+    return latencies
+
+def summarise(latencies):
+    '''Return the p50 and p99 latency in milliseconds and the throughput per second'''
+    latencies = sorted(latencies)
+
+    return {
+        'p50' : percentile(latencies, 0.5) * 1000,
+        'p99' : percentile(latencies, 0.99) * 1000,
+        'throughput' : len(latencies) / sum(latencies) if sum(latencies) else 0.0
+    }
+
+async def benchmark(rounds):
+    '''Run every benchmark and return the summary of each'''
+    ids = count(1)
+    corpus = load(ids)
+    messages = [message for category in corpus.values() for message in category]
+    links = [
+        urlparse(url).netloc
+        for message in messages for url in Shared.extractor.find_urls(message.content)
+    ] or ['example.com']
+
+    async def fresh(message):
+        '''Detect a copy of the message with a new ID so it never counts as spam, uncached'''
+        detector.verdicts.clear()
+        return await detector.scam(Message(next(ids), message.content, message.embeds))
+
+    async def repeat(message):
+        '''Detect a copy of the message with a new ID, reusing the cached verdict'''
+        return await detector.scam(Message(next(ids), message.content, message.embeds))
+
+    async def slash(message):
+        '''Insert the slashes of the URLs of the message'''
+        return slashes(message.content)
+
+    async def decyrillic(message):
+        '''Transform the Cyrillic of the message'''
+        return await detector.decyrillic(message.content)
+
+    async def maliciousterm(message):
+        '''Search the message for malicious terms'''
+        return await detector.contains_maliciousterm(message.content)
+
+    functions = {
+        'slashes' : (slash, messages),
+        'official' : (detector.official, links),
+        'decyrillic' : (decyrillic, messages),
+        'contains_maliciousterm' : (maliciousterm, messages),
+        'spam' : (detector.spam, messages),
+        'scam' : (fresh, messages),
+        'scam (repeat)' : (repeat, messages)
+    }
+    functions.update({
+        f'scam ({category})' : (fresh, category_messages)
+        for category, category_messages in corpus.items()
+    })
+
+    return {
+        name : summarise(await measure(function, arguments, rounds))
+        for name, (function, arguments) in functions.items()
+    }
+
+def report(results, baseline):
+    '''Print the results, compared against the baseline if there is one'''
+    print(f'{"benchmark":<26}{"p50":>10}{"p99":>10}{"calls/s":>12}')
+
+    for name, result in results.items():
+        line = (
+            f'{name:<26}{result["p50"]:>8.3f}ms{result["p99"]:>8.3f}ms'
+            f'{result["throughput"]:>12.0f}'
+        )
+
+        if name in baseline:
+            change = result['p50'] / baseline[name]['p50'] if baseline[name]['p50'] else 1.0
+            line += f'  {change:>6.2f}x p50' + ('  REGRESSION' if change > REGRESSION else '')
+
+        print(line)
+
+def main():
+    '''Parse the arguments, run the benchmarks and save or compare the results'''
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=20, help='passes over the corpus')
+    parser.add_argument('--save', type=Path, help='save the results as a baseline to the file')
+    parser.add_argument('--compare', type=Path, help='compare the results to the baseline file')
+    arguments = parser.parse_args()
+
+    detector.redirect, detector.unsafe = redirect, unsafe
+    db.settings_cache.put(GUILD, db.Settings())
+
+    with TemporaryDirectory() as directory: # reports are saved to the database
+        db.DATABASE = str(Path(directory) / 'database')
+        db.setup()
+
+        try:
+            results = run(benchmark(arguments.rounds))
+        finally:
+            db.close()
+    baseline = {}
+
+    if arguments.compare:
+        baseline = json.loads(arguments.compare.read_text(encoding='utf-8'))
+
+    report(results, baseline)
+
+    if arguments.save:
+        arguments.save.write_text(json.dumps(results, indent=4), encoding='utf-8')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+'''
+Load test the message path (on_message, process, punish, log and prune) against a fake Discord
+
+Run from the repository root: python -m benchmarks.load [--rate 500] [--guilds 1000] [--seconds 10]
+'''
+from argparse import ArgumentParser
+import asyncio
+from collections import Counter
+from datetime import datetime, timezone
+from itertools import count
+import json
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
+from time import monotonic
+
+from aiohttp import web
+import discord
+from discord.http import Route
+from discord.utils import time_snowflake
+
+from benchmarks.detector import CORPUS, redirect, unsafe
+from library import db, detector
+from library.scheduler import percentile, scheduler
+
+BOT = 1
+CHANNELS = 3 # per guild
+LATENCY = (0.02, 0.08) # seconds per request
+BUCKET_LIMIT = 5 # requests per bucket per window
+BUCKET_WINDOW = 1.0
+FORBIDDEN = 0.05 # fraction of guilds which deny moderation
+MISSING = 0.02 # fraction of deletes of messages which are already gone
+SCAMS = 0.03 # fraction of messages which are scams
+WAVES = 0.002 # fraction of messages which start a spam wave
+WAVE_SIZE = 8
+
+def respond(payload, status=200, headers=None):
+    '''Return a JSON response with the exact content type the Discord client expects'''
+    return web.Response(
+        body=json.dumps(payload).encode('utf-8'), status=status, headers=headers,
+        content_type='application/json'
+    )
+
+def user(identifier, name):
+    '''Return the payload of a user'''
+    return {'id' : str(identifier), 'username' : name, 'discriminator' : '0', 'avatar' : None}
+
+def member(identifier, name):
+    '''Return the payload of a member without roles'''
+    return {
+        'user' : user(identifier, name),
+        'roles' : [],
+        'joined_at' : datetime.now(timezone.utc).isoformat(),
+        'deaf' : False,
+        'mute' : False
+    }
+
+def guild(identifier):
+    '''Return the payload of a guild with an @everyone role without permissions and its channels'''
+    return {
+        'id' : str(identifier),
+        'name' : f'guild {identifier}',
+        'owner_id' : str(BOT + 1),
+        'member_count' : 2,
+        'roles' : [{
+            'id' : str(identifier),
+            'name' : '@everyone',
+            'permissions' : '0',
+            'position' : 0,
+            'color' : 0,
+            'colors' : {'primary_color' : 0, 'secondary_color' : None, 'tertiary_color' : None},
+            'hoist' : False,
+            'managed' : False,
+            'mentionable' : False
+        }],
+        'channels' : [
+            {
+                'id' : str(channel),
+                'type' : 0,
+                'name' : f'channel {channel}',
+                'position' : 0,
+                'permission_overwrites' : []
+            }
+            for channel in channels(identifier)
+        ],
+        'members' : [],
+        'emojis' : [],
+        'stickers' : [],
+        'features' : []
+    }
+
+def channels(guild_id):
+    '''Return the IDs of the channels of the guild, from which the guild can be recovered'''
+    return [guild_id * CHANNELS + channel for channel in range(CHANNELS)]
+
+def message(identifier, channel, author, content):
+    '''Return the payload of a message'''
+    return {
+        'id' : str(identifier),
+        'channel_id' : str(channel),
+        'author' : user(author, f'user {author}'),
+        'member' : {key : value for key, value in member(author, '').items() if key != 'user'},
+        'content' : content,
+        'timestamp' : datetime.now(timezone.utc).isoformat(),
+        'edited_timestamp' : None,
+        'tts' : False,
+        'mention_everyone' : False,
+        'mentions' : [],
+        'mention_roles' : [],
+        'attachments' : [],
+        'embeds' : [],
+        'pinned' : False,
+        'type' : 0
+    }
+
+class FakeDiscord:
+    '''A local stand-in for the Discord REST API with rate limit buckets, failures and latency'''
+    def __init__(self, forbidden, random):
+        '''Initialize the API, denying moderation in the forbidden guilds'''
+        self.forbidden = forbidden
+        self.random = random
+        self.buckets = {}
+        self.calls = Counter()
+        self.deleted = {}
+        self.app = web.Application()
+
+        for method, path, major, handler in (
+            ('GET', '/users/@me', None, self.me),
+            ('PATCH', '/guilds/{guild}/members/{member}', 'guild', self.moderate),
+            ('PUT', '/guilds/{guild}/bans/{member}', 'guild', self.moderate),
+            ('DELETE', '/channels/{channel}/messages/{message}', 'channel', self.delete),
+            ('POST', '/channels/{channel}/messages/bulk-delete', 'channel', self.bulk_delete),
+            ('POST', '/channels/{channel}/messages', 'channel', self.send)
+        ):
+            self.app.router.add_route(
+                method, f'/api/v10{path}', self.limited(f'{method} {path}', major, handler)
+            )
+
+    def limited(self, route, major, handler):
+        '''Wrap the handler of the route with latency and a rate limit bucket per major parameter'''
+        async def handle(request):
+            self.calls[route] += 1
+            await asyncio.sleep(self.random.uniform(*LATENCY))
+
+            bucket = f'{route}:{request.match_info.get(major, "")}'
+            now = monotonic()
+            reset, remaining = self.buckets.get(bucket, (now + BUCKET_WINDOW, BUCKET_LIMIT))
+
+            if reset <= now:
+                reset, remaining = now + BUCKET_WINDOW, BUCKET_LIMIT
+
+            if not remaining:
+                self.calls['429 Too Many Requests'] += 1
+                return respond(
+                    {'message' : 'You are being rate limited.', 'retry_after' : reset - now,
+                     'global' : False},
+                    status=429, headers={'Via' : '1.1 google'}
+                )
+
+            self.buckets[bucket] = reset, remaining - 1
+            response = await handler(request)
+            response.headers.update({
+                'X-RateLimit-Limit' : str(BUCKET_LIMIT),
+                'X-RateLimit-Remaining' : str(remaining - 1),
+                'X-RateLimit-Reset-After' : f'{reset - now:.3f}',
+                'X-RateLimit-Bucket' : bucket
+            })
+
+            return response
+
+        return handle
+
+    def denied(self, guild_id):
+        '''Return a 403 response if the guild denies moderation (or None)'''
+        if guild_id in self.forbidden:
+            self.calls['403 Forbidden'] += 1
+            return respond({'message' : 'Missing Permissions', 'code' : 50013}, status=403)
+
+        return None
+
+    async def me(self, _):
+        '''Return the bot user'''
+        return respond(user(BOT, 'asca'))
+
+    async def moderate(self, request):
+        '''Time out or ban the member'''
+        if response := self.denied(int(request.match_info['guild'])):
+            return response
+
+        self.calls['punishments'] += 1
+        return respond(member(int(request.match_info['member']), 'member'))
+
+    async def delete(self, request):
+        '''Delete a message, which may be gone already'''
+        if response := self.denied(int(request.match_info['channel']) // CHANNELS):
+            return response
+
+        if self.random.random() < MISSING:
+            self.calls['404 Not Found'] += 1
+            return respond({'message' : 'Unknown Message', 'code' : 10008}, status=404)
+
+        self.deleted.setdefault(int(request.match_info['message']), monotonic())
+        return web.Response(status=204)
+
+    async def bulk_delete(self, request):
+        '''Delete the messages'''
+        if response := self.denied(int(request.match_info['channel']) // CHANNELS):
+            return response
+
+        for identifier in (await request.json())['messages']:
+            self.deleted.setdefault(int(identifier), monotonic())
+
+        return web.Response(status=204)
+
+    async def send(self, request):
+        '''Send a message'''
+        payload = await request.json()
+        sent = message(
+            time_snowflake(datetime.now(timezone.utc)), int(request.match_info['channel']), BOT,
+            payload.get('content', '')
+        )
+
+        return respond(sent | {'author' : user(BOT, 'asca')})
+
+class Stream:
+    '''A synthetic stream of clean messages, scams and spam waves into the guilds'''
+    def __init__(self, bot, guilds, random):
+        '''Initialize the stream of messages into the guilds of the bot'''
+        corpus = json.loads(Path(CORPUS).read_text(encoding='utf-8'))
+        self.contents = {
+            scam : [entry['content'] for entry in corpus if entry['category'] in categories]
+            for scam, categories in ((False, {'clean', 'link-heavy'}), (True, {'scam'}))
+        }
+        self.bot, self.guilds, self.random = bot, guilds, random
+        self.ids = count(time_snowflake(datetime.now(timezone.utc)))
+        self.sent = {}
+
+    def send(self, guild_id, author, content):
+        '''Dispatch a message as if it came from the gateway'''
+        channel = self.bot.get_guild(guild_id).get_channel(self.random.choice(channels(guild_id)))
+        identifier = next(self.ids)
+
+        self.sent[identifier] = monotonic()
+        self.bot.dispatch('message', discord.Message(
+            state=self.bot._connection, # pylint: disable=protected-access
+            channel=channel,
+            data=message(identifier, channel.id, author, content)
+        ))
+
+    async def run(self, rate, seconds, tick=0.01):
+        '''Send messages at the rate for the seconds, returning the scams and waves sent'''
+        sent = Counter()
+        start = monotonic()
+
+        for step in range(int(seconds / tick)):
+            for _ in range(round(rate * tick)):
+                guild_id, author = self.random.choice(self.guilds), self.random.randrange(10, 10**9)
+                draw = self.random.random()
+
+                if draw < WAVES:
+                    content = self.random.choice(self.contents[False])
+                    for _ in range(WAVE_SIZE):
+                        self.send(guild_id, author, content)
+                    sent['spam waves'] += 1
+                else:
+                    scam = draw < WAVES + SCAMS
+                    self.send(guild_id, author, self.random.choice(self.contents[scam]))
+                    sent['scams'] += scam
+
+            await asyncio.sleep(max(0.0, start + (step + 1) * tick - monotonic()))
+
+        sent['messages'] = len(self.sent)
+        sent['seconds'] = monotonic() - start
+        return sent
+
+async def monitor(lags, interval=0.01):
+    '''Sample the lag of the event loop forever'''
+    while True:
+        start = monotonic()
+        await asyncio.sleep(interval)
+        lags.append(monotonic() - start - interval)
+
+async def drain(timeout=60):
+    '''Wait until the processing tasks and the scheduler are idle (or the timeout)'''
+    deadline = monotonic() + timeout
+
+    while monotonic() < deadline:
+        busy = [task for task in asyncio.all_tasks() if 'on_message' in task.get_name()]
+
+        if not busy and not scheduler.workers:
+            return
+
+        await asyncio.sleep(0.1)
+
+def milliseconds(samples):
+    '''Return the p50, p99 and maximum of the samples in milliseconds'''
+    samples = sorted(samples)
+    return (
+        f'p50 {percentile(samples, 0.5) * 1000:.1f}ms  p99 {percentile(samples, 0.99) * 1000:.1f}ms'
+        f'  max {(samples[-1] if samples else 0) * 1000:.1f}ms'
+    )
+
+def report(sent, api, stream, lags):
+    '''Print the throughput, latencies and API calls of the run'''
+    latencies = [
+        api.deleted[identifier] - stream.sent[identifier]
+        for identifier in api.deleted if identifier in stream.sent
+    ]
+    punishments = api.calls['punishments']
+
+    print(f'Sent {sent["messages"]} messages in {sent["seconds"]:.1f}s '
+          f'({sent["messages"] / sent["seconds"]:.0f}/s), '
+          f'{sent["scams"]} scams and {sent["spam waves"]} spam waves')
+    print(f'{punishments} punishments, {len(latencies)} messages deleted')
+    print(f'Detection to delete  {milliseconds(latencies)}')
+    print(f'Event loop lag       {milliseconds(lags)}')
+    print(f'{"API calls":<52}{"total":>8}{"per punishment":>16}')
+
+    for route, calls in sorted(api.calls.items()):
+        if route != 'punishments':
+            print(f'{route:<52}{calls:>8}{calls / punishments if punishments else 0:>16.2f}')
+
+async def load(arguments):
+    '''Run the fake API and the bot and stream the messages into its listeners'''
+    random = Random(arguments.seed)
+    guilds = list(range(1000, 1000 + arguments.guilds))
+    api = FakeDiscord(set(random.sample(guilds, int(len(guilds) * FORBIDDEN))), random)
+
+    runner = web.AppRunner(api.app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    Route.API_BASE_URL = f'http://127.0.0.1:{runner.addresses[0][1]}/api/v{{API_VERSION}}'
+
+    intents = discord.Intents(guilds=True, guild_messages=True, message_content=True)
+    bot = discord.Bot(intents=intents)
+    await bot.http.static_login('token')
+
+    for guild_id in guilds:
+        bot._connection._add_guild_from_data(guild(guild_id)) # pylint: disable=protected-access
+
+    for guild_id in random.sample(guilds, len(guilds) // 10):
+        await db.set_logging_channel(guild_id, channels(guild_id)[0])
+
+    @bot.listen()
+    async def on_message(dispatched): # mirrors the listener of bot.py
+        await detector.process(dispatched)
+
+    lags = []
+    sampler = asyncio.create_task(monitor(lags))
+    stream = Stream(bot, guilds, random)
+
+    sent = await stream.run(arguments.rate, arguments.seconds)
+    await drain()
+    sampler.cancel()
+
+    report(sent, api, stream, lags)
+
+    await bot.http.close()
+    await runner.cleanup()
+
+def main():
+    '''Parse the arguments and run the load test against a temporary database'''
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rate', type=int, default=500, help='messages per second')
+    parser.add_argument('--guilds', type=int, default=1000, help='number of guilds')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of the stream')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic stream')
+    arguments = parser.parse_args()
+
+    detector.redirect, detector.unsafe = redirect, unsafe
+
+    with TemporaryDirectory() as directory:
+        db.DATABASE = str(Path(directory) / 'database')
+        db.setup()
+
+        try:
+            asyncio.run(load(arguments))
+        finally:
+            db.close()
+
+if __name__ == '__main__':
+    main()
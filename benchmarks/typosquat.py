@@ -0,0 +1,90 @@
+'''
+Benchmark lookalike detection against brand lists of growing size
+and check the verdicts of known lookalike and legitimate domains
+
+Run from the repository root: python -m benchmarks.typosquat
+'''
+from asyncio import run
+from random import Random
+from string import ascii_lowercase
+from time import perf_counter
+
+from library.typosquat import Brands, lookalike, read, skeleton, tolerance, transpositions
+
+SIZES = (25, 50, 100, 200)
+DOMAINS = (
+    'dlscord', 'discorde', 'stearn', 'steamcommunlty', 'rob1ox', 'epicgamez', 'disboard',
+    'google', 'wikipedia', 'reddit', 'stackoverflow', 'imgur', 'tenor', 'twitter'
+)
+LOOKALIKES = ('githab.com', 'epicgame.com', 'mine-craft.io', 'stearn.com', 'dlscord.gift')
+LEGITIMATE = ('telegra.ph', 'paypay.ne.jp', 'tiktokv.com', 'gitlab.com', 'steamdb.info')
+
+def brandlist(size, random):
+    '''Return the brand list padded with random words up to the size'''
+    brands = read()
+
+    while len(brands) < size:
+        brands.append(''.join(random.choices(ascii_lowercase, k=random.randint(5, 14))))
+
+    return brands
+
+def linear(brands, domain):
+    '''Compare the domain against every brand, the way a list of SequenceMatchers would'''
+    folded = skeleton(domain)
+
+    return min(
+        (
+            (distance, brand) for brand in brands
+            if domain != brand
+            and (distance := transpositions(folded, skeleton(brand))) <= tolerance(brand)
+        ),
+        default=None
+    )
+
+def measure(function, repeat=5):
+    '''Return the best time in seconds of looking up every domain with the function'''
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = perf_counter()
+
+        for domain in DOMAINS:
+            function(domain)
+
+        best = min(best, perf_counter() - start)
+
+    return best
+
+async def check():
+    '''Return the known lookalikes which are missed and the legitimate domains which are caught'''
+    return [
+        domain for domain in LOOKALIKES if not await lookalike(domain)
+    ] + [
+        domain for domain in LEGITIMATE if await lookalike(domain)
+    ]
+
+def main():
+    '''
+    Print the time per domain of a linear scan and of the index for each brand list size,
+    and exit with an error if a known domain gets the wrong verdict
+    '''
+    random = Random(0)
+    print(f'{"brands":>6}', f'{"linear":>14}', f'{"indexed":>14}')
+
+    for size in SIZES:
+        listed = brandlist(size, random)
+        brands = Brands(listed)
+        timings = (
+            measure(lambda domain, listed=listed: linear(listed, domain)),
+            measure(brands.closest)
+        )
+
+        print(f'{size:>6}', *(f'{timing / len(DOMAINS) * 1e6:>10.1f}µs' for timing in timings))
+
+    print('The index only compares the brands sharing a deletion with the domain')
+
+    if wrong := run(check()):
+        raise SystemExit(f'Wrong lookalike verdicts: {", ".join(wrong)}')
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 '''Entry point'''
-from asyncio import sleep
+from asyncio import run, sleep
+from collections import Counter
 from getpass import getpass
 import logging
 from os import environ as env
@@ -9,19 +10,27 @@ import sys
 import discord
 from discord.ext import tasks, commands
 
-from library import db
+from library import db, requester
 from library.backup import backup_db
 from library.detector import Secrets, process
 from library.error import cantlog, notowner, invalid_days
-from library.links import update
-from library.reports import reportmessage, getreport
+from library.links import load, update
+from library.metrics import monitor, summary
+from library.threatlist import threatdb
+from library.reports import reportmessage, getreport, restore
 from library.ui import Whitelist
+from library.urls import refresh
+from library.workers import pool
 
 signal(SIGINT, lambda signalnumber, stackframe: sys.exit())
 
 logging.basicConfig()
 
 DEVSERVER_ENVVAR = 'ASCA_DEVSERVER'
+LOCAL_THREATS_ENVVAR = 'ASCA_LOCAL_THREATS'
+METRICS_ENVVAR = 'ASCA_METRICS_PORT'
+WORKERS_ENVVAR = 'ASCA_WORKERS'
+PERIODS = {'All time' : None, 'Last 24 hours' : 1, 'Last 7 days' : 7, 'Last 30 days' : 30}
 
 if DEVSERVER_ENVVAR not in env:
     print(f'Set {DEVSERVER_ENVVAR}=𝗜𝗗 in env')
@@ -33,7 +42,24 @@ except ValueError as invalid_devserver:
     print(f'{DEVSERVER_ENVVAR} must be an int')
     raise SystemExit(1) from invalid_devserver
 
+try:
+    metrics_port = int(env.get(METRICS_ENVVAR, 0))
+except ValueError as invalid_metrics_port:
+    print(f'{METRICS_ENVVAR} must be an int')
+    raise SystemExit(1) from invalid_metrics_port
+
+try:
+    workers = int(env.get(WORKERS_ENVVAR, 0))
+except ValueError as invalid_workers:
+    print(f'{WORKERS_ENVVAR} must be an int')
+    raise SystemExit(1) from invalid_workers
+
 # init
+pool.start(workers) # fork the workers before the database (or any other) thread starts
+db.setup()
+load()
+restore()
+
 intents = discord.Intents(guilds=True, guild_messages=True, message_content=True)
 bot = discord.Bot(intents=intents)
 
@@ -53,6 +79,8 @@ async def on_ready():
     '''Print info when ready'''
     print('Logged in as', bot.user)
 
+    await monitor(metrics_port)
+
 # tasks
 @tasks.loop(minutes=30)
 async def update_scamlinks():
@@ -61,6 +89,22 @@ async def update_scamlinks():
 
 update_scamlinks.start()
 
+@tasks.loop(hours=24)
+async def update_tlds():
+    '''Update the TLDs known to the URL extractor periodically (the workers catch up with it)'''
+    await refresh()
+
+update_tlds.start()
+
+@tasks.loop(minutes=5)
+async def update_threats():
+    '''Sync the local Safe Browsing lists periodically (as often as the API allows)'''
+    await threatdb.sync(Secrets.safebrowsing)
+
+if LOCAL_THREATS_ENVVAR in env:
+    threatdb.load()
+    update_threats.start()
+
 @tasks.loop(hours=1)
 async def update_status():
     '''Update status'''
@@ -74,6 +118,13 @@ async def update_status():
 
 update_status.start()
 
+@tasks.loop(hours=1)
+async def compact_rollups():
+    '''Compact the old punishment rollups periodically'''
+    await db.compact()
+
+compact_rollups.start()
+
 @tasks.loop(hours=1)
 async def backup_database(channel):
     '''Backup the database periodically to the channel'''
@@ -83,13 +134,13 @@ async def backup_database(channel):
 @bot.listen()
 async def on_message(message):
     '''Handle messages'''
-    await process(message, bot.cached_messages)
+    await process(message)
 
 @bot.listen()
 async def on_message_edit(previous_message, current_message):
     '''Handle message edits'''
     if current_message.content != previous_message.content:
-        await process(current_message, bot.cached_messages)
+        await process(current_message)
 
 # commands
 @bot.slash_command(guild_only=True)
@@ -128,10 +179,30 @@ async def timeoutdays_error(ctx, error):
         raise error
 
 @bot.slash_command(guild_only=True)
-async def punishments(ctx):
+async def punishments(
+    ctx,
+    period : discord.Option(str, 'Choose the period:', choices=list(PERIODS), default='All time')
+):
     '''Get the punishment count for this guild'''
-    count = await db.get_punishment_count(ctx.guild.id)
-    await ctx.respond(f'{count} Timeouts / Bans for this server', ephemeral=True)
+    days = PERIODS[period]
+
+    if days is None:
+        count = await db.get_punishment_count(ctx.guild.id)
+        await ctx.respond(f'{count} Timeouts / Bans for this server', ephemeral=True)
+        return
+
+    breakdown = await db.get_punishment_breakdown(ctx.guild.id, days)
+    reasons = {}
+
+    for (reason, mode), count in breakdown.items():
+        reasons.setdefault(reason, Counter())[mode] += count
+
+    lines = [f'{sum(breakdown.values())} Timeouts / Bans for this server ({period.lower()})']
+    lines.extend(
+        f'- {reason}: {modes["timeout"]} Timeouts / {modes["ban"]} Bans'
+        for reason, modes in sorted(reasons.items(), key=lambda item: -item[1].total())
+    )
+    await ctx.respond('\n'.join(lines), ephemeral=True)
 
 @bot.slash_command(guild_only=True)
 @commands.bot_has_permissions(send_messages=True)
@@ -205,6 +276,19 @@ async def reports_error(ctx, error):
     else:
         raise error
 
+@bot.slash_command(guild_ids=[devserver], checks=[lambda ctx: bot.is_owner(ctx.author)])
+async def metrics(ctx):
+    '''Get a summary of the metrics'''
+    await ctx.respond(f'```\n{summary()[:1900]}```', ephemeral=True)
+
+@metrics.error
+async def metrics_error(ctx, error):
+    '''Handle not being the Bot Owner'''
+    if isinstance(error, discord.CheckFailure):
+        await notowner(ctx)
+    else:
+        raise error
+
 @bot.slash_command()
 async def servers(ctx):
     '''Get the server count of the bot'''
@@ -228,3 +312,7 @@ try:
 except discord.LoginFailure as loginfailure:
     print('Invalid Token')
     raise SystemExit(1) from loginfailure
+finally:
+    run(requester.close())
+    pool.stop()
+    db.close()
@@ -1,16 +1,56 @@
 '''Database backup'''
-from discord import File
+from asyncio import get_running_loop
+from contextlib import suppress
+from datetime import datetime, timezone
+import gzip
+from pathlib import Path
+import shutil
+from tempfile import TemporaryDirectory
 
-from library.db import prune
-from library.paths import DATABASE
+from discord import File, NotFound
+
+from library.db import prune, snapshot
+
+KEEP = 24 # backups kept in the channel
+PREFIX = 'database'
+
+def compress(source, target):
+    '''Stream the source file through gzip into the target file'''
+    with open(source, mode='rb') as source_file, gzip.open(target, mode='wb') as target_file:
+        shutil.copyfileobj(source_file, target_file)
+
+def isbackup(message):
+    '''Determine and return whether the message is a backup sent by the bot'''
+    return message.author == message.guild.me and any(
+        attachment.filename.startswith(PREFIX) for attachment in message.attachments
+    )
+
+async def rotate(channel, keep=KEEP):
+    '''Delete the backups in the channel older than the newest few'''
+    backups = 0
+
+    async for message in channel.history(limit=None):
+        if isbackup(message):
+            backups += 1
+
+            if backups > keep:
+                with suppress(NotFound):
+                    await message.delete()
 
 async def backup_db(channel, guilds):
     '''
-    Prune the database for guilds the bot is not in
-    and then backup the database to the channel
+    Prune the database for guilds the bot is not in,
+    backup a compressed snapshot of the database to the channel and rotate the older backups
     '''
     await prune(guilds)
-    await channel.purge()
 
-    with open(DATABASE, mode='rb') as database_file:
-        await channel.send(file=File(database_file, filename='database'))
+    with TemporaryDirectory() as directory:
+        copy = Path(directory, PREFIX)
+        archive = Path(directory, f'{PREFIX}-{datetime.now(timezone.utc):%Y%m%d-%H%M}.sqlite.gz')
+
+        await snapshot(copy)
+        await get_running_loop().run_in_executor(None, compress, copy, archive)
+
+        await channel.send(file=File(archive))
+
+    await rotate(channel)
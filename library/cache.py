@@ -0,0 +1,78 @@
+'''Bounded in-memory caches'''
+from collections import OrderedDict
+from time import monotonic
+
+class LRUCache:
+    '''A bounded mapping which evicts the least recently used entry and counts hits and misses'''
+    def __init__(self, maxsize):
+        '''Initialize an empty cache holding at most maxsize entries'''
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        '''Get and return the value of the key (or the default if it is not cached)'''
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        '''Cache the value of the key, evicting the least recently used entry when full'''
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        '''Remove the key from the cache if it is present'''
+        self.entries.pop(key, None)
+
+    def clear(self):
+        '''Remove every entry from the cache'''
+        self.entries.clear()
+
+    def hitrate(self):
+        '''Return the fraction of lookups which were hits'''
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+class TTLCache(LRUCache):
+    '''A bounded LRU cache whose entries expire after their time to live'''
+    def __init__(self, maxsize, ttl):
+        '''Initialize an empty cache holding at most maxsize entries for ttl seconds by default'''
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        '''Get and return the unexpired value of the key (or the default if it is not cached)'''
+        entry = super().get(key)
+
+        if entry is None:
+            return default
+
+        expiry, value = entry
+        if expiry <= monotonic():
+            self.discard(key)
+            self.hits -= 1
+            self.misses += 1
+            return default
+
+        return value
+
+    def put(self, key, value, ttl=None):
+        '''Cache the value of the key for ttl seconds (or the default time to live)'''
+        super().put(key, (monotonic() + (self.ttl if ttl is None else ttl), value))
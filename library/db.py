@@ -1,130 +1,370 @@
 '''Database interface'''
-from contextlib import asynccontextmanager
+from asyncio import get_running_loop
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass, field
 from enum import Enum
+from pathlib import Path
+import logging
 import sqlite3
+from threading import local
+from time import time
 
-from library.paths import DATABASE
+from library import metrics
+from library.cache import LRUCache
+from library.matcher import Prefixes
+from library.paths import DATABASE, MIGRATIONS
 
 MODES = Enum('MODES', 'TIMEOUT BAN')
 DEFAULT_TIMEOUT_DAYS = 7
+FLUSH_INTERVAL = 5 # seconds punishment events wait in memory before they are written
+FLUSH_SIZE = 100 # punishment events which are written at once without waiting
+HOUR = 60 * 60
+DAY = 24 * HOUR
+COMPACT_AFTER = 7 * DAY # age of the hourly punishment rollups which are compacted into days
+TABLES = ( # tables of data per guild
+    'modes', 'periods', 'punishments', 'punishment_events', 'punishment_rollups',
+    'logs', 'whitelist'
+)
 
-@asynccontextmanager
-async def connect():
-    '''Manage the database connection, yields a cursor'''
-    connection = sqlite3.connect(DATABASE)
-    cursor = connection.cursor()
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+thread = local()
 
-    createdb_script_path = 'create_database.sql'
-    with open(createdb_script_path, encoding='utf-8') as createdb_script_file:
-        cursor.executescript(createdb_script_file.read())
+@dataclass(frozen=True)
+class Settings:
+    '''The settings of a guild'''
+    mode : MODES = MODES.TIMEOUT
+    days : int = DEFAULT_TIMEOUT_DAYS
+    channel : int = None
+    whitelist : tuple = ()
+    trie : Prefixes = field(default_factory=Prefixes, compare=False)
 
-    try:
-        yield cursor
-    finally:
-        connection.commit()
-        connection.close()
+settings_cache = LRUCache(10000)
+metrics.gauge('cache_hit_ratio', settings_cache.hitrate, cache='settings')
+
+def migrate(connection):
+    '''Apply the migrations newer than the schema version of the database'''
+    version = connection.execute('pragma user_version').fetchone()[0]
+
+    for migration in sorted(Path(MIGRATIONS).glob('*.sql')):
+        number = int(migration.stem.split('_')[0])
+
+        if number > version:
+            script = migration.read_text(encoding='utf-8')
+            connection.executescript(f'begin;\n{script}\npragma user_version = {number};\ncommit;')
+
+def connect():
+    '''Open the long-lived connection of the database thread and migrate the database'''
+    if getattr(thread, 'connection', None) is None:
+        thread.connection = sqlite3.connect(DATABASE)
+        thread.connection.execute('pragma journal_mode = wal')
+        thread.connection.execute('pragma synchronous = normal')
+        migrate(thread.connection)
+
+    return thread.connection
+
+def transact(work):
+    '''Run the work with a cursor in a transaction on the database thread and return its result'''
+    with connect() as connection:
+        return work(connection.cursor())
+
+def disconnect():
+    '''Close the connection of the database thread'''
+    if getattr(thread, 'connection', None) is not None:
+        thread.connection.close()
+        thread.connection = None
+
+def setup():
+    '''Open and migrate the database, blocking until it is ready'''
+    executor.submit(connect).result()
+
+def close():
+    '''Write the buffered punishment events, close the database and stop the database thread'''
+    punishments.flush()
+    executor.submit(disconnect).result()
+    executor.shutdown()
+
+async def run(work):
+    '''Run the work on the database thread without blocking the event loop and return its result'''
+    with metrics.timer('call_seconds', call='database'):
+        return await get_running_loop().run_in_executor(executor, transact, work)
+
+async def execute(query, parameters=()):
+    '''Execute the query'''
+    await run(lambda cursor: cursor.execute(query, parameters))
+
+async def fetchone(query, parameters=()):
+    '''Execute the query and return the first row'''
+    return await run(lambda cursor: cursor.execute(query, parameters).fetchone())
+
+async def fetchall(query, parameters=()):
+    '''Execute the query and return all rows'''
+    return await run(lambda cursor: cursor.execute(query, parameters).fetchall())
+
+def copy(path):
+    '''Copy the database to the path in one read transaction of a connection of its own'''
+    with closing(sqlite3.connect(DATABASE)) as source, closing(sqlite3.connect(path)) as target:
+        source.backup(target)
+
+async def snapshot(path):
+    '''
+    Copy a consistent snapshot of the database to the path with the online backup API,
+    off the database thread, which keeps serving queries and writes meanwhile (WAL)
+    '''
+    with metrics.timer('call_seconds', call='database'):
+        await get_running_loop().run_in_executor(None, copy, path)
+
+def load(cursor, guild):
+    '''Read and return the settings of the guild'''
+    mode = cursor.execute('select * from modes where guild = ?', (guild,)).fetchone()
+    days = cursor.execute('select days from periods where guild = ?', (guild,)).fetchone()
+    channel = cursor.execute('select channel from logs where guild = ?', (guild,)).fetchone()
+    whitelist = tuple(
+        url for url, in cursor.execute('select link from whitelist where guild = ?', (guild,))
+    )
+
+    return Settings(
+        mode=MODES.BAN if mode else MODES.TIMEOUT,
+        days=days[0] if days else DEFAULT_TIMEOUT_DAYS,
+        channel=channel[0] if channel else None,
+        whitelist=whitelist,
+        trie=Prefixes(whitelist)
+    )
+
+async def settings(guild):
+    '''Get and return the settings of the guild, reading them from the database on a cache miss'''
+    cached = settings_cache.get(guild)
+
+    if cached is None:
+        cached = await run(lambda cursor: load(cursor, guild))
+        settings_cache.put(guild, cached)
+
+    return cached
+
+async def change(query, parameters):
+    '''Execute the query changing the settings of the guild (the first parameter)'''
+    await execute(query, parameters)
+    settings_cache.discard(parameters[0])
 
 async def getmode(guild):
     '''Get and return whether the guild is in Timout or Ban mode'''
-    async with connect() as cursor:
-        mode = cursor.execute('select * from modes where guild = ?', (guild,)).fetchone()
-
-    if not mode:
-        return MODES.TIMEOUT
-    return MODES.BAN
+    return (await settings(guild)).mode
 
 async def set_timeoutmode(guild):
     '''Set the punishment mode of the guild to Timeout'''
-    async with connect() as cursor:
-        cursor.execute('delete from modes where guild = ?', (guild,))
+    await change('delete from modes where guild = ?', (guild,))
 
 async def setbanmode(guild):
     '''Set the punishment mode of the guild to Ban'''
-    async with connect() as cursor:
-        cursor.execute('insert into modes values(?)', (guild,))
+    await change('insert into modes values(?)', (guild,))
 
 async def get_timeoutperiod(guild):
     '''Retrieve and return the timeout period for the guild'''
-    async with connect() as cursor:
-        days = cursor.execute('select days from periods where guild = ?', (guild,)).fetchone()
-
-    if not days:
-        return DEFAULT_TIMEOUT_DAYS
-    return days[0]
+    return (await settings(guild)).days
 
 async def set_timeoutperiod(guild, days):
     '''Set the timeout period for the guild'''
-    async with connect() as cursor:
-        if days == DEFAULT_TIMEOUT_DAYS:
-            cursor.execute('delete from periods where guild = ?', (guild,))
-        else:
-            cursor.execute('replace into periods values (?, ?)', (guild, days))
+    if days == DEFAULT_TIMEOUT_DAYS:
+        await change('delete from periods where guild = ?', (guild,))
+    else:
+        await change('replace into periods values (?, ?)', (guild, days))
+
+def write(cursor, events):
+    '''
+    Append the punishment events to the log
+    and add them to the totals and the hourly rollups of their guilds
+    '''
+    cursor.executemany(
+        'insert into punishment_events(guild, user, reason, mode, time) values (?, ?, ?, ?, ?)',
+        events
+    )
+    cursor.executemany(
+        'insert into punishments values (?, ?) '
+        'on conflict(guild) do update set total = total + excluded.total',
+        Counter(event[0] for event in events).items()
+    )
+    cursor.executemany(
+        'insert into punishment_rollups values (?, ?, ?, ?, ?, ?) '
+        'on conflict do update set total = total + excluded.total',
+        (
+            (guild, bucket, HOUR, reason, mode, total)
+            for (guild, bucket, reason, mode), total in Counter(
+                (guild, int(when // HOUR) * HOUR, reason, mode)
+                for guild, _, reason, mode, when in events
+            ).items()
+        )
+    )
+
+def written(future):
+    '''Log the failure of a write of punishment events'''
+    if future.exception() is not None:
+        logging.getLogger(__name__).error(
+            'Failed to write punishment events', exc_info=future.exception()
+        )
+
+class Punishments:
+    '''
+    Punishment events buffered in memory and written behind in one transaction per batch,
+    when the oldest has waited the flush interval or the batch reaches the flush size
+    '''
+    def __init__(self):
+        '''Initialize an empty buffer'''
+        self.pending = []
+        self.timer = None
+
+    def record(self, guild, user, reason, mode):
+        '''Buffer the punishment event'''
+        self.pending.append((guild, user, reason, mode.name.lower(), time()))
+
+        if len(self.pending) >= FLUSH_SIZE:
+            self.flush()
+        elif self.timer is None:
+            self.timer = get_running_loop().call_later(FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        '''Queue the buffered events to be written on the database thread'''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        events, self.pending = self.pending, []
+
+        if events:
+            executor.submit(transact, lambda cursor: write(cursor, events)).add_done_callback(
+                written
+            )
+
+    def count(self, guild):
+        '''Return how many of the buffered events are of the guild'''
+        return sum(event[0] == guild for event in self.pending)
+
+    def breakdown(self, guild, since):
+        '''Return how many buffered events of the guild since the time have each reason and mode'''
+        return Counter(
+            (reason, mode) for event_guild, _, reason, mode, when in self.pending
+            if event_guild == guild and when >= since
+        )
+
+punishments = Punishments()
 
 async def get_punishment_count(guild):
     '''Get and return the timeouts/bans for the guild'''
-    async with connect() as cursor:
-        count = cursor.execute('select total from punishments where guild = ?', (guild,)).fetchone()
+    pending = punishments.count(guild) # before the read, which queues behind any earlier flush
+    count = await fetchone('select total from punishments where guild = ?', (guild,))
 
-    if not count:
-        return 0
-    return count[0]
+    return (count[0] if count else 0) + pending
 
-async def count_punishment(guild):
-    '''Increment punishment count for the guild'''
-    async with connect() as cursor:
-        count = cursor.execute('select total from punishments where guild = ?', (guild,)).fetchone()
+async def get_punishment_breakdown(guild, days):
+    '''
+    Get and return the timeouts/bans for the guild in the last days by reason and mode,
+    to the nearest bucket of the rollups
+    '''
+    since = time() - days * DAY
+    breakdown = punishments.breakdown(guild, since)
+    rows = await fetchall(
+        'select reason, mode, sum(total) from punishment_rollups '
+        'where guild = ? and bucket > ? and bucket + span > ? group by reason, mode',
+        (guild, since - DAY, since)
+    )
 
-        if not count:
-            cursor.execute('insert into punishments values (?, ?)', (guild, 1))
-        else:
-            count = count[0]
+    breakdown.update({(reason, mode) : total for reason, mode, total in rows})
+    return breakdown
 
-            cursor.execute('update punishments set total = ? where guild = ?', (count + 1, guild))
+async def compact(now=None):
+    '''Compact the hourly punishment rollups older than a week into daily rollups'''
+    cutoff = int(((now or time()) - COMPACT_AFTER) // DAY) * DAY
 
-async def get_logging_channel(guild):
-    '''Get and return the logging channel of the guild (or None if it is not set)'''
-    async with connect() as cursor:
-        channel = cursor.execute('select channel from logs where guild = ?', (guild,)).fetchone()
+    def work(cursor):
+        cursor.execute(
+            'insert into punishment_rollups '
+            'select guild, bucket - bucket % ?, ?, reason, mode, sum(total) '
+            'from punishment_rollups where span = ? and bucket < ? '
+            'group by 1, 2, 4, 5 '
+            'on conflict do update set total = total + excluded.total',
+            (DAY, DAY, HOUR, cutoff)
+        )
+        cursor.execute(
+            'delete from punishment_rollups where span = ? and bucket < ?', (HOUR, cutoff)
+        )
 
-    if channel:
-        channel = channel[0]
+    await run(work)
 
-    return channel
+async def count_punishment(guild, user, reason, mode):
+    '''Record a punishment of the user of the guild for the reason in the mode'''
+    punishments.record(guild, user, reason, mode)
+
+async def get_logging_channel(guild):
+    '''Get and return the logging channel of the guild (or None if it is not set)'''
+    return (await settings(guild)).channel
 
 async def set_logging_channel(guild, channel):
     '''Sets the logging channel of the guild'''
-    async with connect() as cursor:
-        cursor.execute('replace into logs values (?, ?)', (guild, channel))
+    await change('replace into logs values (?, ?)', (guild, channel))
 
 async def delete_logging_channel(guild):
     '''Delete the logging channel of the guild'''
-    async with connect() as cursor:
-        cursor.execute('delete from logs where guild = ?', (guild,))
+    await change('delete from logs where guild = ?', (guild,))
 
 async def getwhitelist(guild):
     '''Get and return the guilds whitelist'''
-    async with connect() as cursor:
-        return [
-            url[0] for url in cursor.execute(
-                'select link from whitelist where guild = ?', [guild])
-            .fetchall()
-        ]
-
-async def addwhitelist(guild, url):
-    '''Add the URL to the guilds whitelist'''
-    async with connect() as cursor:
-        cursor.execute('insert into whitelist(guild, link) values (?, ?)', [guild, url])
+    return list((await settings(guild)).whitelist)
+
+async def get_whitelist_trie(guild):
+    '''Get and return the prefix trie of the guilds whitelist'''
+    return (await settings(guild)).trie
+
+async def setwhitelist(guild, urls):
+    '''Replace the guilds whitelist with the URLs in one transaction'''
+    def work(cursor):
+        cursor.execute('delete from whitelist where guild = ?', (guild,))
+        cursor.executemany(
+            'insert into whitelist(guild, link) values (?, ?)', ((guild, url) for url in urls)
+        )
+
+    await run(work)
+    settings_cache.discard(guild)
 
 async def clearwhitelist(guild):
     '''Clear the guilds whitelist'''
-    async with connect() as cursor:
-        cursor.execute('delete from whitelist where guild = ?', [guild])
+    await change('delete from whitelist where guild = ?', [guild])
+
+def getreports():
+    '''Read and return the reports in the order they were made, blocking until they are read'''
+    query = 'select key, message, count from reports order by id'
+    return executor.submit(transact, lambda cursor: cursor.execute(query).fetchall()).result()
+
+async def putreport(key, message, count):
+    '''Save the report of the key'''
+    await execute(
+        'insert into reports(key, message, count) values (?, ?, ?) '
+        'on conflict(key) do update set count = excluded.count',
+        (key, message, count)
+    )
+
+async def deletereport(key):
+    '''Delete the report of the key'''
+    await execute('delete from reports where key = ?', (key,))
 
 async def prune(guilds):
-    '''Prune the database for guilds the bot is not in'''
-    tables = {'modes', 'periods', 'punishments', 'logs'}
-    placeholders = ', '.join('?' * len(guilds))
+    '''
+    Prune the database for guilds the bot is not in,
+    joining against a temporary table of the guilds (as many as there are)
+    '''
+    def work(cursor):
+        cursor.execute('create temp table if not exists joined(guild integer primary key)')
+        cursor.execute('delete from joined')
+        cursor.executemany(
+            'insert or ignore into joined values (?)', ((guild,) for guild in guilds)
+        )
+
+        for table in TABLES:
+            cursor.execute(
+                f'delete from {table} where not exists '
+                f'(select 1 from joined where joined.guild = {table}.guild)'
+            )
+
+        cursor.execute('drop table temp.joined')
 
-    async with connect() as cursor:
-        for table in tables:
-            cursor.execute(f'delete from {table} where guild not in ({placeholders})', guilds)
+    await run(work)
+    settings_cache.clear()
@@ -1,123 +1,111 @@
 '''Scam detection and punishment'''
-from asyncio import Lock, sleep
+import asyncio
 from contextlib import suppress
 from dataclasses import dataclass
-from datetime import datetime, timezone, timedelta
-from difflib import SequenceMatcher
-from re import search
+from datetime import timedelta
+from enum import Enum
+from hashlib import blake2b
 from string import Template
 from urllib.parse import urlparse
 
-from discord import Embed, Colour, DMChannel, User, Forbidden, NotFound, HTTPException
+from discord import Embed, Colour, DMChannel, Message, User, Forbidden, NotFound, HTTPException
 from discord.utils import remove_markdown
-from pysafebrowsing import SafeBrowsing
-from pysafebrowsing.api import SafeBrowsingWeirdError
-from tldextract import extract
-from urlextract import URLExtract
 import validators
 
-from library import db
-from library.links import links
+from library import db, metrics
+from library.cache import TTLCache
+from library.domains import VERDICTS, Revision, normalise, reputation
+from library.fingerprint import duplicates
+from library.matcher import Automaton
+from library.pipeline import COSTS, Pipeline, Stage
 from library.reports import reportmessage
 from library.requester import redirect
+from library.safebrowsing import safebrowsing
+from library.scheduler import scheduler
+from library.threatlist import threatdb
+from library.tracker import tracker
+from library.typosquat import lookalike
+from library.urls import Shared, cut, findlinks, reload
+from library.workers import pool
 
 @dataclass
 class Secrets:
     '''Storage of secrets'''
     safebrowsing : str = None
 
-deletelock = Lock()
+TERMS = Enum('TERMS', 'MALICIOUS PASSTHROUGH')
+CYRILLIC = str.maketrans({
+    'з' : '3',
+    'ч' : '4',
+    'а' : 'a',
+    'в' : 'b',
+    'с' : 'c',
+    'е' : 'e',
+    'н' : 'h',
+    'к' : 'k',
+    'м' : 'm',
+    'о' : 'o',
+    'р' : 'p',
+    'т' : 't',
+    'х' : 'x',
+    'у' : 'y'
+})
+
+SCAM_TTL = 3600 # seconds to cache the verdicts of scams
+CLEAN_TTL = 300 # seconds to cache the verdicts of clean messages, which lists may catch up on
+
 permission_error_template = Template('Scam detected, but I need the `$permission` permission '
                                      'or to be placed higher on the `Roles` list')
 
+terms = Automaton(
+    (''.join(term.split()), category)
+    for category, category_terms in {
+        TERMS.MALICIOUS : (
+            'nitro',
+            'password:',
+            'who is first?',
+            'who will catch this gift?',
+            'take it guys',
+            'i stopped playing cs:go',
+            'can you check out the game i created today',
+            'test my first game',
+            'i made a game can you test play?',
+            'i have coded a new game',
+            'farm cryptocurrency',
+            'from the crypto market'
+        ),
+        TERMS.PASSTHROUGH : (
+            '+1 (256) 482-1848',
+            '+1 (518) 952-5213',
+            '+1 (531) 254-0859',
+            '+1 (559) 666‑3967',
+            '+1 (757) 861‑3217',
+            'on how to earn'
+        )
+    }.items()
+    for term in category_terms
+)
+
+INVITES = frozenset({
+    'eesex',
+    'family-hub',
+    'tiktok18',
+    'tiktok-xxx',
+    'boobis',
+    'anastasynudes',
+    'esexies',
+    'e-sexies',
+    'annanudes',
+    'kQWvAJXu27'
+})
+
 async def official(link):
     '''Determine and return whether the link is official'''
-    official_links = {
-        'airhorn.solutions',
-        'airhornbot.com',
-        'bigbeans.solutions',
-        'dis.gd',
-        'discord-activities.com',
-        'discord.co',
-        'discord.com',
-        'discord.design',
-        'discord.dev',
-        'discord.gg',
-        'discord.gift',
-        'discord.gifts',
-        'discord.media',
-        'discord.new',
-        'discord.store',
-        'discord.tools',
-        'discordactivities.com',
-        'discordapp.com',
-        'discordapp.io',
-        'discordapp.net',
-        'discordcdn.com',
-        'discordmerch.com',
-        'discordpartygames.com',
-        'discordsays.com',
-        'discordstatus.com',
-        'watchanimeattheoffice.com',
-
-        'discord.app',
-        'discordjs.guide',
-        'discord.me',
-        'discords.com',
-        'ondiscord.xyz'
-    }
-
-    for official_link in official_links:
-        if link == official_link or link.endswith(f'.{official_link}'):
-            return True
-
-    return False
+    return await reputation(link) == VERDICTS.OFFICIAL
 
 async def decyrillic(text):
     '''Transform Cyrillic into ASCII and return the transformation'''
-    replacements = {
-        'з' : '3',
-        'ч' : '4',
-        'а' : 'a',
-        'в' : 'b',
-        'с' : 'c',
-        'е' : 'e',
-        'н' : 'h',
-        'к' : 'k',
-        'м' : 'm',
-        'о' : 'o',
-        'р' : 'p',
-        'т' : 't',
-        'х' : 'x',
-        'у' : 'y'
-    }
-
-    return text.translate(str.maketrans(replacements))
-
-async def slash(message, tlds):
-    '''Insert a forward slash into the message after TLDs not succeeded by one and return it'''
-    urls = {word for word in message.split(' ') if word.startswith('http')}
-
-    for url in urls:
-        match = search(r'^(([^:/?#]+):)?(//([^/?#]*))?([^?#]*)(\?([^#]*))?(#(.*))?', url)
-
-        path = match.group(5)
-        if not path:
-            domain = match.group(4)
-            try:
-                tld = sorted((tld for tld in tlds if tld in domain),
-                            key=lambda tld, domain=domain : (domain.rfind(tld), len(tld)))[-1]
-            except (TypeError, IndexError):
-                continue
-            newdomain = f'{tld}/'.join(domain.rsplit(tld, maxsplit=1))
-
-            message = message.replace(domain, newdomain)
-
-    return message
-
-async def protocol(url):
-    '''Add a protocol to the URL if it does not currently have one and return it'''
-    return f'https://{url}' if not url.startswith('http') else url
+    return text.translate(CYRILLIC)
 
 async def removewhitespace(message):
     '''Remove whitespace from message and return it'''
@@ -125,164 +113,286 @@ async def removewhitespace(message):
 
 async def contains_invite(code):
     '''Determine and return whether the invite code is malicious'''
-    codes = {
-        'eesex',
-        'family-hub',
-        'tiktok18',
-        'tiktok-xxx',
-        'boobis',
-        'anastasynudes',
-        'esexies',
-        'e-sexies',
-        'annanudes',
-        'kQWvAJXu27'
-    }
-
-    return code in codes
+    return code in INVITES
+
+async def maliciousterms(message):
+    '''Find and return the categories of the malicious terms the message contains'''
+    return {category for _, category in terms.search(await removewhitespace(message))}
 
 async def contains_maliciousterm(message):
     '''Determine and return whether the message contains a malicious term'''
-    message = await removewhitespace(message)
-
-    terms = {
-        'nitro',
-        'password:',
-        await removewhitespace('who is first?'),
-        await removewhitespace('who will catch this gift?'),
-        await removewhitespace('take it guys'),
-        await removewhitespace('i stopped playing cs:go'),
-        await removewhitespace('can you check out the game i created today'),
-        await removewhitespace('test my first game'),
-        await removewhitespace('i made a game can you test play?'),
-        await removewhitespace('i have coded a new game'),
-        await removewhitespace('farm cryptocurrency'),
-        await removewhitespace('from the crypto market')
-    }
-
-    return any(term in message for term in terms)
-
-async def contains_passthrough_maliciousterm(message):
+    return TERMS.MALICIOUS in await maliciousterms(message)
+
+async def unsafe(urls):
     '''
-    Determine and return whether the message contains a malicious term
-    which can be punished without a link
+    Determine and return whether the URLs are unsafe,
+    or None if none is known to be but some could not be looked up
     '''
-    message = await removewhitespace(message)
+    if threatdb.ready():
+        with metrics.timer('call_seconds', call='threatlist'):
+            return await threatdb.lookup(urls, Secrets.safebrowsing)
 
-    phone_numbers = {
-        await removewhitespace('+1 (256) 482-1848'),
-        await removewhitespace('+1 (518) 952-5213'),
-        await removewhitespace('+1 (531) 254-0859'),
-        await removewhitespace('+1 (559) 666‑3967'),
-        await removewhitespace('+1 (757) 861‑3217'),
-        await removewhitespace('on how to earn')
-    }
+    with metrics.timer('call_seconds', call='safebrowsing'):
+        return await safebrowsing.lookup(urls, Secrets.safebrowsing)
 
-    return any(phone_number in message for phone_number in phone_numbers)
-
-async def unsafe(urls):
-    '''Determine and return whether the URLs are unsafe'''
-    try:
-        return any(
-            result['malicious']
-            for result in SafeBrowsing(Secrets.safebrowsing).lookup_urls(tuple(urls)).values()
-        )
-    except SafeBrowsingWeirdError:
-        return False
+async def spam(message, maxrepeat=5):
+    '''Determine and return whether the message is spam'''
+    repeats = tracker.repeats(message, window=10), duplicates.repeats(message, window=10)
+    return max(repeats) > maxrepeat
 
-async def spamcache(message, cached_messages, time):
+@dataclass(slots=True, frozen=True)
+class Analysis:
     '''
-    Get and return possible spam messages from the current message and the cached messages,
-    sent within the time period
+    The normalised text of a message, the URLs it contains, their hosts
+    and the categories of its malicious terms
     '''
-    return {
-        cached_message for cached_message in cached_messages
-        if datetime.now(timezone.utc) - cached_message.created_at < time
-        and message.guild == cached_message.guild
-        and message.author == cached_message.author
-        and (message.content and message.content == cached_message.content or
-            message.stickers and message.stickers == cached_message.stickers)
-    }
-
-async def spam(message, cached_messages, maxrepeat=5):
-    '''Determine and return whether the message is spam'''
-    return len(await spamcache(message, cached_messages, timedelta(seconds=10))) > maxrepeat
+    text : str
+    urls : frozenset
+    hosts : frozenset
+    categories : frozenset
 
-async def scam(message, cached_messages): # pylint: disable=too-many-branches, too-many-return-statements
-    '''Determine and return whether the message is a scam, returns 'Spam' if the message is spam'''
-    fmessage = remove_markdown(message.content.replace('http', ' http').replace('://\n', '://'))
+SHED = Analysis('', frozenset(), frozenset(), frozenset()) # only the spam check runs
 
-    link_extractor = URLExtract()
-    link_extractor.update_when_older(1)
+def hosts(urls):
+    '''Return the normalised hosts of the URLs'''
+    return frozenset(normalise(urlparse(url).netloc) for url in urls)
 
-    tlds = {tld for tld in link_extractor._load_cached_tlds() if tld in fmessage} # pylint: disable=protected-access
-    fmessage = await slash(fmessage, tlds)
+def scan(content, revision):
+    '''
+    Normalise the content of a message and return it with its valid links
+    (pure CPU work, run by the workers, which catch up with the revision of the TLD list)
+    '''
+    if revision != Shared.revision:
+        reload(revision)
 
-    urls = await redirect({
-        await protocol(url) for url in link_extractor.find_urls(fmessage, only_unique=True)
-        if not any(url.startswith(entry) for entry in await db.getwhitelist(message.guild.id))
-    })
+    fmessage = remove_markdown(content.replace('http', ' http').replace('://\n', '://'))
 
-    for url in urls:
-        try:
-            validators.url(url)
-        except validators.ValidationFailure:
-            urls.remove(url)
+    fmessage, message_urls = findlinks(fmessage)
 
-    fmessage = await decyrillic(fmessage.lower())
+    return fmessage, tuple(link for link in message_urls if validators.url(link.url))
+
+def analyse(fmessage, links, trie):
+    '''
+    Find the links of the scanned message outside the whitelist trie
+    and its malicious terms, and return the analysis
+    '''
+    urls = frozenset(link.url for link in links if not trie.match(link.url))
 
-    message_links = {
-        message_link.lower()
-        for message_link in {urlparse(url).netloc for url in urls}
-        if not await official(message_link.lower())
-    }
-    report = '\n'.join(message_links)
+    fmessage = cut(fmessage, {
+        link for link in links
+        if link.url in urls and fmessage[slice(*link.span)] == link.url
+    })
 
-    if urls and await unsafe(urls):
-        return True
+    text = fmessage.lower().translate(CYRILLIC)
+    categories = frozenset(category for _, category in terms.search(''.join(text.split())))
 
-    for message_link in message_links:
-        domain = extract(message_link).domain
-        ratio = SequenceMatcher(a='discord', b=domain).ratio()
-        threshold = 0.85
+    return Analysis(text, urls, hosts(urls), categories)
 
-        if message_link in links:
+@dataclass
+class Context:
+    '''
+    The normalised text of a message, the URLs and links it contains
+    and whether every network lookup on them completed
+    '''
+    message : Message
+    text : str
+    urls : set
+    links : set
+    categories : set
+    complete : bool = True
+
+async def inspect(message, analysis):
+    '''Gather and return the context of the message with its analysis'''
+    links = {link for link in analysis.hosts if not await official(link)}
+
+    return Context(message, analysis.text, set(analysis.urls), links, set(analysis.categories))
+
+async def listed(context):
+    '''Determine and return whether a link is a listed scam'''
+    for link in context.links:
+        if await reputation(link) == VERDICTS.SCAM:
             return True
 
-        if threshold < ratio < 1:
-            await reportmessage(report)
+    return False
+
+async def lookalikes(context):
+    '''Determine and return whether a link impersonates a brand'''
+    for link in context.links:
+        if await lookalike(link):
             return True
 
-    for url in urls:
+    return False
+
+async def invite(context):
+    '''Determine and return whether a URL is a malicious invite'''
+    for url in context.urls:
         parsedurl = urlparse(url)
 
-        if parsedurl.netloc == 'discord.gg' and await contains_invite(parsedurl.path.lstrip('/')):
+        if parsedurl.netloc == 'discord.gg' and await contains_invite(parsedurl.path.strip('/')):
             return True
 
+    return False
+
+async def executable(context):
+    '''Determine and return whether a URL links to an executable or an archive'''
+    for url in context.urls:
+        parsedurl = urlparse(url)
+
         if any(ext in parsedurl.path + parsedurl.query for ext in ('.exe', '.msi', '.zip', '.rar')):
-            await reportmessage(report)
             return True
 
-        fmessage = fmessage.replace(url, '')
+    return False
 
-    if message_links:
-        if await contains_maliciousterm(fmessage):
-            await reportmessage(report)
+async def malicious(context):
+    '''Determine and return whether the message has links and malicious terms'''
+    return bool(context.links) and TERMS.MALICIOUS in context.categories
+
+async def impersonation(context):
+    '''Determine and return whether the message has links and an embed claiming to be Discord'''
+    if not context.links:
+        return False
+
+    for embed in context.message.embeds:
+        if embed.provider.name and (await decyrillic(embed.provider.name)).lower() == 'discord':
             return True
 
-        for embed in message.embeds:
-            if embed.provider.name and (await decyrillic(embed.provider.name)).lower() == 'discord':
-                await reportmessage(report)
-                return True
+    return False
 
-    if await contains_passthrough_maliciousterm(fmessage):
-        await reportmessage(report)
-        return True
+async def passthrough(context):
+    '''Determine and return whether the message has malicious terms punished without a link'''
+    return TERMS.PASSTHROUGH in context.categories
 
-    if await spam(message, cached_messages):
-        await reportmessage(report)
-        return 'Spam'
+async def spammed(context):
+    '''Determine and return whether the message is spam'''
+    return await spam(context.message)
 
-    return False
+async def unsafeurls(context):
+    '''Determine and return whether Safe Browsing lists a URL'''
+    if not context.urls:
+        return False
+
+    if (verdict := await unsafe(context.urls)) is None:
+        context.complete = False
+
+    return bool(verdict)
+
+async def redirected(context):
+    '''Determine and return whether a shortened URL redirects to a scam'''
+    if not context.urls:
+        return False
+
+    resolved, complete = await redirect(context.urls)
+    context.complete &= complete
+
+    if not (resolved := resolved - context.urls):
+        return False
+
+    analysis = Analysis(context.text, frozenset(resolved), hosts(resolved), context.categories)
+    stage = await detect(linkpipeline, resolvedcontext := await inspect(context.message, analysis))
+    context.complete &= resolvedcontext.complete
+
+    return bool(stage)
+
+stages = {
+    stage.name : stage for stage in (
+        Stage('Unsafe', COSTS.NETWORK, unsafeurls),
+        Stage('Redirect', COSTS.NETWORK, redirected),
+        Stage('Scam link', COSTS.LOCAL, listed),
+        Stage('Lookalike', COSTS.LOCAL, lookalikes, report=True),
+        Stage('Invite', COSTS.LOCAL, invite),
+        Stage('Executable', COSTS.LOCAL, executable, report=True),
+        Stage('Malicious terms', COSTS.LOCAL, malicious, report=True),
+        Stage('Impersonation', COSTS.LOCAL, impersonation, report=True),
+        Stage('Passthrough terms', COSTS.LOCAL, passthrough, report=True),
+        Stage('Spam', COSTS.LOCAL, spammed, report=True)
+    )
+}
+pipeline = Pipeline(stages.values())
+linkpipeline = Pipeline(
+    stages[name] for name in ('Unsafe', 'Scam link', 'Lookalike', 'Invite', 'Executable')
+)
+spampipeline = Pipeline([stages['Spam']])
+
+for stage_name in pipeline.stats(): # the stages are shared, so these count every pipeline
+    metrics.gauge(
+        'stage_runs', lambda name=stage_name: pipeline.stats()[name][0], stage=stage_name
+    )
+    metrics.gauge(
+        'stage_fires', lambda name=stage_name: pipeline.stats()[name][1], stage=stage_name
+    )
+
+verdicts = TTLCache(10000, CLEAN_TTL)
+judging = {}
+metrics.gauge('cache_hit_ratio', verdicts.hitrate, cache='verdicts')
+
+async def detect(stage_pipeline, context):
+    '''Run the pipeline on the context and return the stage which fired, reporting if it asks to'''
+    stage = await stage_pipeline.run(context)
+
+    if stage and stage.report:
+        await reportmessage('\n'.join(context.links))
+
+    return stage
+
+def fingerprint(message, trie):
+    '''
+    Return the fingerprint of everything the verdict of the message depends on but its author:
+    its content and embed providers, the whitelist and the revision of the scam link index
+    '''
+    digest = blake2b(digest_size=16)
+
+    for part in (message.content.strip(), *(embed.provider.name or '' for embed in message.embeds)):
+        digest.update(part.encode())
+        digest.update(b'\0')
+
+    digest.update(trie.digest)
+
+    return digest.digest(), Revision.number
+
+async def judge(message, trie, key):
+    '''
+    Analyse the message and run the pipeline on it, caching the verdict unless it depends
+    on the author (spam), the analysis was shed or it is clean but a lookup did not complete,
+    and return the stage which fired
+    '''
+    future = judging[key] = asyncio.get_running_loop().create_future()
+    entry = None
+
+    try:
+        # only the content goes to the workers, the whitelist is checked here
+        scanned = await pool.submit(scan, message.content, Shared.revision)
+        analysis = analyse(*scanned, trie) if scanned else SHED
+        stage = await detect(pipeline, context := await inspect(message, analysis))
+
+        if analysis is not SHED and stage is not stages['Spam'] and (stage or context.complete):
+            entry = stage.name if stage else None, analysis
+            verdicts.put(key, entry, SCAM_TTL if stage else CLEAN_TTL)
+
+        return stage
+    finally:
+        if judging.get(key) is future:
+            del judging[key]
+        future.set_result(entry)
+
+async def scam(message):
+    '''
+    Determine and return the reason the message is a scam, 'Spam' if the message is spam,
+    or False if it is neither, reusing the verdict of an identical message
+    '''
+    trie = await db.get_whitelist_trie(message.guild.id)
+    key = fingerprint(message, trie)
+
+    if (entry := verdicts.get(key)) is None and key in judging: # an identical message is in flight
+        entry = await asyncio.shield(judging[key])
+
+    if entry is None:
+        stage = await judge(message, trie, key)
+    elif entry[0]:
+        return entry[0]
+    else: # clean content, but its author may be spamming it
+        stage = await detect(spampipeline, await inspect(message, entry[1]))
+
+    return stage.name if stage else False
 
 async def reply(message, replymessage):
     '''Reply to a message with a reply'''
@@ -320,22 +430,19 @@ async def ban(message, reason):
         await reply(message, permission_error_template.substitute(permission='Ban Members'))
         return False
 
+async def undeletable(message):
+    '''Reply to the message that it cannot be deleted without the Manage Messages permission'''
+    await reply(message, permission_error_template.substitute(permission='Manage Messages'))
+
 async def delete(message):
     '''Deletes the message'''
     try:
         await message.delete()
     except Forbidden:
-        await reply(message, permission_error_template.substitute(permission='Manage Messages'))
+        await undeletable(message)
     except NotFound:
         pass
 
-async def prune(messages):
-    '''Deletes the messages'''
-    async with deletelock:
-        for message in messages:
-            await delete(message)
-            await sleep(5)
-
 async def punish(message, is_spam):
     '''Punish the member which sent the message and return whether the punishment was successful'''
     if isinstance(message.author, User):
@@ -356,9 +463,10 @@ async def punish(message, is_spam):
         case db.MODES.BAN:
             return await ban(message, reason)
 
-async def log(message, is_spam):
-    '''Logs the punishment'''
-    await db.count_punishment(message.guild.id)
+async def log(message, reason):
+    '''Logs the punishment for the reason'''
+    mode = await db.getmode(message.guild.id)
+    await db.count_punishment(message.guild.id, message.author.id, reason, mode)
 
     logging_channel = await db.get_logging_channel(message.guild.id)
 
@@ -368,7 +476,6 @@ async def log(message, is_spam):
         if logging_channel: # logging channel still exists
             scam_message = message.content.replace('`', '')
 
-            mode = await db.getmode(message.guild.id)
             action = {
                 db.MODES.TIMEOUT : 'Timed out',
                 db.MODES.BAN     : 'Banned'
@@ -380,7 +487,7 @@ async def log(message, is_spam):
             title = f'{action} {message.author}'
             logembed.set_author(icon_url=message.author.display_avatar.url, name=title)
 
-            if is_spam:
+            if reason == 'Spam':
                 logembed.add_field(name='Note', value='This message was spammed')
 
             logembed.add_field(name='Mention', value=message.author.mention)
@@ -396,12 +503,23 @@ async def log(message, is_spam):
         else:
             await db.delete_logging_channel(message.guild.id)
 
-async def process(message, cached_messages):
+async def process(message):
     '''Processes a message'''
     if message.author.bot or isinstance(message.channel, DMChannel):
         return
 
-    if ((is_scam := await scam(message, cached_messages))
-        and await punish(message, is_scam == 'Spam')):
-        await log(message, is_scam == 'Spam')
-        await prune(await spamcache(message, cached_messages, timedelta.max))
+    tracker.track(message)
+    duplicates.track(message)
+
+    is_scam = await scam(message)
+    metrics.count('verdicts_total', reason=is_scam or 'Clean')
+
+    if not is_scam:
+        return
+
+    if await scheduler.perform(message.guild.id, punish, message, is_scam == 'Spam'):
+        with metrics.timer('action_seconds', action='log'):
+            await log(message, is_scam)
+        scheduler.cleanup(
+            message.guild, tracker.prunable(message) | duplicates.prunable(message), undeletable
+        )
@@ -0,0 +1,120 @@
+'''Reputation of domains'''
+from dataclasses import dataclass
+from enum import Enum
+from re import compile as regex
+
+VERDICTS = Enum('VERDICTS', 'UNKNOWN OFFICIAL SCAM')
+DOTS = str.maketrans(dict.fromkeys('。．｡', '.')) # IDNA label separators
+CANONICAL = regex(r'[a-z0-9_-]+(?:\.[a-z0-9_-]+)*')
+
+OFFICIAL = frozenset({
+    'airhorn.solutions',
+    'airhornbot.com',
+    'bigbeans.solutions',
+    'dis.gd',
+    'discord-activities.com',
+    'discord.co',
+    'discord.com',
+    'discord.design',
+    'discord.dev',
+    'discord.gg',
+    'discord.gift',
+    'discord.gifts',
+    'discord.media',
+    'discord.new',
+    'discord.store',
+    'discord.tools',
+    'discordactivities.com',
+    'discordapp.com',
+    'discordapp.io',
+    'discordapp.net',
+    'discordcdn.com',
+    'discordmerch.com',
+    'discordpartygames.com',
+    'discordsays.com',
+    'discordstatus.com',
+    'watchanimeattheoffice.com',
+
+    'discord.app',
+    'discordjs.guide',
+    'discord.me',
+    'discords.com',
+    'ondiscord.xyz'
+})
+
+def punycode(label):
+    '''Encode and return the label in its ASCII (punycode) form'''
+    if label.isascii():
+        return label
+
+    try:
+        return label.encode('idna').decode('ascii')
+    except UnicodeError:
+        return f'xn--{label.encode("punycode").decode("ascii")}'
+
+def normalise(host):
+    '''
+    Normalise and return the host:
+    lowercase, without credentials, port or trailing dots, with labels in ASCII (punycode) form
+    '''
+    if CANONICAL.fullmatch(host):
+        return host
+
+    host = host.strip().rpartition('@')[2].split('/')[0]
+
+    if not host.startswith('['): # not an IPv6 address
+        host = host.partition(':')[0]
+
+    host = host.lower().translate(DOTS).strip('.')
+    return '.'.join(punycode(label) for label in host.split('.'))
+
+def build(scams):
+    '''Build and return an index of the scam domains and the official domains'''
+    domains = {normalise(scam): VERDICTS.SCAM for scam in scams if scam.strip()}
+    domains.update(dict.fromkeys(OFFICIAL, VERDICTS.OFFICIAL))
+
+    return domains
+
+index = build(())
+
+@dataclass
+class Revision:
+    '''Storage of the revision of the index, which changes whenever the index does'''
+    number : int = 0
+
+def lookup(host):
+    '''
+    Look up and return the verdict of the normalised host,
+    walking up from the host to its parent domains until one is indexed
+    '''
+    while '.' in host:
+        if verdict := index.get(host):
+            return verdict
+
+        host = host.partition('.')[2]
+
+    return VERDICTS.UNKNOWN
+
+async def reputation(host):
+    '''Determine and return whether the host is official, a listed scam or unknown'''
+    return lookup(normalise(host))
+
+def rebuild(scams):
+    '''Rebuild the index from the scam domains'''
+    rebuilt = build(scams)
+
+    index.clear()
+    index.update(rebuilt)
+    Revision.number += 1
+
+async def amend(added, removed):
+    '''Amend the index with the added and removed scam domains in one step'''
+    for domain in map(normalise, removed):
+        if index.get(domain) == VERDICTS.SCAM:
+            del index[domain]
+
+    for domain in map(normalise, added):
+        index.setdefault(domain, VERDICTS.SCAM)
+
+    if added or removed:
+        Revision.number += 1
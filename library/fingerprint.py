@@ -0,0 +1,208 @@
+'''Near-duplicate detection via SimHash fingerprints and a banded LSH index'''
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from functools import lru_cache
+from time import time
+from unicodedata import category, normalize
+
+from library.tracker import Record
+
+BITS = 64
+SHINGLE = 3
+MASK = (1 << BITS) - 1
+MINIMUM_LENGTH = 20 # shorter messages are too noisy to fingerprint
+
+def clean(text):
+    '''
+    Normalise and return the text for fingerprinting:
+    compatibility-decomposed, case-folded, without invisible characters or whitespace
+    '''
+    text = normalize('NFKC', text).casefold()
+    return ''.join(character for character in text
+                   if not character.isspace() and category(character) != 'Cf')
+
+@lru_cache(maxsize=4096)
+def fingerprint(text):
+    '''Compute and return the 64-bit SimHash of the text (or None if it is too short)'''
+    text = clean(text)
+
+    if len(text) < MINIMUM_LENGTH:
+        return None
+
+    shingles = {text[start:start + SHINGLE] for start in range(len(text) - SHINGLE + 1)}
+    # the builtin string hash is salted per process, which suits fingerprints kept in memory
+    bits = ''.join(format(hash(shingle) & MASK, f'0{BITS}b') for shingle in shingles)
+    majority = len(shingles) / 2
+
+    return int(''.join(
+        '1' if bits[column::BITS].count('1') > majority else '0' for column in range(BITS)
+    ), 2)
+
+def bands(value, count):
+    '''Split the fingerprint into count bands and return them tagged with their position'''
+    width, extra = divmod(BITS, count)
+    split = []
+    position = 0
+
+    for band in range(count):
+        size = width + (band < extra)
+        split.append((band, (value >> position) & ((1 << size) - 1)))
+        position += size
+
+    return split
+
+@dataclass(slots=True, frozen=True)
+class Entry:
+    '''A fingerprinted message'''
+    fingerprint : int
+    author : int
+    record : Record
+
+class Index:
+    '''A banded LSH index of the fingerprints of the recent messages of a guild, per author'''
+    def __init__(self, bandcount, capacity):
+        '''Initialize an empty index splitting fingerprints into bandcount bands'''
+        self.bandcount = bandcount
+        self.entries = deque()
+        self.capacity = capacity
+        self.buckets = {}
+        self.messages = {}
+
+    def add(self, entry):
+        '''Index the entry in place of any of the same message, evicting the oldest when full'''
+        if (previous := self.messages.get(entry.record.id)) is not None: # an edit
+            self.remove(previous)
+
+        self.entries.append(entry)
+        self.messages[entry.record.id] = entry
+
+        for band in bands(entry.fingerprint, self.bandcount):
+            self.buckets.setdefault((entry.author, band), set()).add(entry)
+
+        if len(self.entries) > self.capacity:
+            self.evict()
+
+    def evict(self):
+        '''Remove the oldest entry'''
+        self.remove(self.entries.popleft())
+
+    def remove(self, entry):
+        '''Remove the entry from the buckets (it is skipped when it leaves the entries)'''
+        if self.messages.get(entry.record.id) is entry:
+            del self.messages[entry.record.id]
+
+        for band in bands(entry.fingerprint, self.bandcount):
+            bucket = self.buckets.get((entry.author, band), set())
+            bucket.discard(entry)
+
+            if not bucket:
+                self.buckets.pop((entry.author, band), None)
+
+    def expire(self, horizon):
+        '''Remove the entries older than the horizon'''
+        while self.entries and self.entries[0].record.time < horizon:
+            self.evict()
+
+    def near(self, author, value, distance):
+        '''
+        Return the entries of the author whose fingerprints are within the Hamming distance
+        of the value
+        '''
+        return {
+            entry
+            for band in bands(value, self.bandcount)
+            for entry in self.buckets.get((author, band), ())
+            if (entry.fingerprint ^ value).bit_count() <= distance
+        }
+
+class Duplicates:
+    '''
+    Per guild LSH indexes of recent messages, counting near-duplicates across channels.
+    Fingerprints within the distance share at least one of distance + 1 bands (pigeonhole),
+    so only the messages in those buckets are compared
+    '''
+    def __init__(self, distance=10, retention=120, capacity=2000, maxentries=20000):
+        '''
+        Initialize the indexes, treating fingerprints within the Hamming distance as near,
+        keeping at most capacity entries per guild and maxentries across guilds
+        '''
+        self.distance = distance
+        self.retention = retention
+        self.capacity = capacity
+        self.maxentries = maxentries
+        self.size = 0
+        self.indexes = OrderedDict()
+
+    def track(self, message):
+        '''Fingerprint and index the message'''
+        value = fingerprint(message.content)
+
+        if value is not None:
+            index = self.indexes.pop(message.guild.id, None)
+            index = index or Index(self.distance + 1, self.capacity)
+            self.indexes[message.guild.id] = index
+            self.size -= len(index.entries)
+
+            index.add(Entry(
+                value,
+                message.author.id,
+                Record(message.id, message.channel.id, message.created_at.timestamp())
+            ))
+            index.expire(time() - self.retention)
+            self.size += len(index.entries)
+
+        self.expire()
+
+    def expire(self):
+        '''
+        Remove the expired entries and the oldest beyond the bound across guilds,
+        and the indexes left empty, least recently used first
+        '''
+        horizon = time() - self.retention
+
+        while self.indexes:
+            guild, index = next(iter(self.indexes.items()))
+            self.size -= len(index.entries)
+            index.expire(horizon)
+
+            while index.entries and self.size + len(index.entries) > self.maxentries:
+                index.evict()
+
+            self.size += len(index.entries)
+
+            if index.entries:
+                break
+
+            del self.indexes[guild]
+
+    def duplicates(self, message):
+        '''Return the entries of the near-duplicates of the message sent by its author'''
+        value = fingerprint(message.content)
+        index = self.indexes.get(message.guild.id)
+
+        if value is None or index is None:
+            return set()
+
+        return index.near(message.author.id, value, self.distance)
+
+    def repeats(self, message, window=10):
+        '''
+        Return how many distinct messages near-duplicating the message
+        were sent within the window (seconds)
+        '''
+        horizon = time() - window
+        return len({
+            entry.record.id for entry in self.duplicates(message) if entry.record.time > horizon
+        })
+
+    def prunable(self, message):
+        '''Remove and return the records of the near-duplicates of the message'''
+        found = self.duplicates(message)
+        index = self.indexes.get(message.guild.id)
+
+        for entry in found:
+            index.remove(entry)
+
+        return {entry.record for entry in found}
+
+duplicates = Duplicates()
@@ -1,14 +1,67 @@
-'''Transient management of scam links'''
+'''Persistent management of scam links'''
+from asyncio import get_running_loop
+from contextlib import suppress
+from dataclasses import dataclass
+import json
+import logging
+import os
+from pathlib import Path
+
+from library.domains import amend, rebuild
+from library.paths import LINKS
 from library.requester import scamlinks
 
 links = set()
 pendinglinks = set()
 
+@dataclass
+class Validators:
+    '''Storage of the validators of the last fetched scam links'''
+    etag : str = None
+    modified : str = None
+
+def load():
+    '''Load the persisted scam links and index them'''
+    with suppress(FileNotFoundError, KeyError, ValueError):
+        snapshot = json.loads(Path(LINKS).read_text(encoding='utf-8'))
+
+        links.update(snapshot['links'])
+        Validators.etag, Validators.modified = snapshot['etag'], snapshot['modified']
+
+    links.update(pendinglinks)
+    rebuild(links)
+
+def save(snapshot):
+    '''Atomically persist the snapshot of the scam links'''
+    path = Path(LINKS)
+    temporary = path.with_name(f'{path.name}.tmp')
+
+    temporary.write_text(json.dumps(snapshot), encoding='utf-8')
+    os.replace(temporary, path)
+
 async def update():
-    '''Updates scam links'''
-    response = await scamlinks()
+    '''Updates scam links and returns the added and removed links'''
+    response = await scamlinks(Validators.etag, Validators.modified)
+
+    if not response or not response[0] or not response[0].strip(): # failed or unchanged
+        return set(), set()
+
+    text, etag, modified = response
+    fetched = {link.strip() for link in text.splitlines() if link.strip()} | pendinglinks
+
+    added, removed = fetched - links, links - fetched
+    links.difference_update(removed)
+    links.update(added)
+    await amend(added, removed)
+
+    Validators.etag, Validators.modified = etag, modified
+    await get_running_loop().run_in_executor(
+        None, save, {'etag' : etag, 'modified' : modified, 'links' : sorted(links)}
+    )
+
+    if added or removed:
+        logging.getLogger(__name__).info(
+            'Scam links updated: %d added, %d removed', len(added), len(removed)
+        )
 
-    if response:
-        links.clear()
-        links.update(response.splitlines())
-        links.update(pendinglinks)
+    return added, removed
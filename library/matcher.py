@@ -0,0 +1,102 @@
+'''Multi-pattern string matching'''
+from collections import deque
+from hashlib import blake2b
+
+class Automaton:
+    '''An Aho-Corasick automaton which finds every pattern in a text in a single pass'''
+    def __init__(self, patterns):
+        '''Compile the automaton from (pattern, category) pairs'''
+        self.transitions = [{}]
+        self.failures = [0]
+        self.outputs = [()]
+
+        for pattern, category in patterns:
+            if pattern:
+                self.insert(pattern, category)
+
+        self.link()
+
+    def insert(self, pattern, category):
+        '''Add the pattern to the trie of the automaton'''
+        state = 0
+
+        for character in pattern:
+            if character not in self.transitions[state]:
+                self.transitions.append({})
+                self.failures.append(0)
+                self.outputs.append(())
+                self.transitions[state][character] = len(self.transitions) - 1
+
+            state = self.transitions[state][character]
+
+        self.outputs[state] += ((pattern, category),)
+
+    def link(self):
+        '''Link every state to the state of its longest proper suffix, breadth first'''
+        queue = deque(self.transitions[0].values())
+
+        while queue:
+            state = queue.popleft()
+
+            for character, child in self.transitions[state].items():
+                failure = self.failures[state]
+                while failure and character not in self.transitions[failure]:
+                    failure = self.failures[failure]
+
+                self.failures[child] = self.transitions[failure].get(character, 0)
+                self.outputs[child] += self.outputs[self.failures[child]]
+                queue.append(child)
+
+    def finditer(self, text):
+        '''Yield (end, pattern, category) for every occurrence of a pattern in the text'''
+        transitions, failures, outputs = self.transitions, self.failures, self.outputs
+        state = 0
+
+        for end, character in enumerate(text, start=1):
+            while state and character not in transitions[state]:
+                state = failures[state]
+
+            state = transitions[state].get(character, 0)
+
+            for pattern, category in outputs[state]:
+                yield end, pattern, category
+
+    def search(self, text):
+        '''Return the set of (pattern, category) pairs found in the text'''
+        return {(pattern, category) for _, pattern, category in self.finditer(text)}
+
+END = None # key of the nodes where a pattern ends
+
+class Prefixes:
+    '''A trie of patterns which finds whether any of them prefixes a text in a single pass'''
+    def __init__(self, patterns=()):
+        '''Compile the trie from the patterns'''
+        self.patterns = tuple(patterns)
+        self.root = {}
+        # identifies the patterns, so callers need not hash them all again
+        self.digest = blake2b(b'\0'.join(pattern.encode() for pattern in self.patterns)).digest()
+
+        for pattern in self.patterns:
+            if pattern:
+                self.insert(pattern)
+
+    def insert(self, pattern):
+        '''Add the pattern to the trie'''
+        node = self.root
+
+        for character in pattern:
+            node = node.setdefault(character, {})
+
+        node[END] = True
+
+    def match(self, text):
+        '''Return whether a pattern is a prefix of the text'''
+        node = self.root
+
+        for character in text:
+            if END in node:
+                return True
+            if (node := node.get(character)) is None:
+                return False
+
+        return END in node
@@ -0,0 +1,175 @@
+'''Latency histograms, counters and gauges, exposed in the Prometheus text format'''
+import asyncio
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import monotonic, perf_counter
+
+from aiohttp import web
+
+BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+PREFIX = 'asca'
+
+class Histogram:
+    '''Counts of observations in cumulative buckets, with their sum'''
+    def __init__(self, buckets=BUCKETS):
+        '''Initialize an empty histogram with the upper bounds of the buckets'''
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        '''Count the value in its bucket'''
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''Return the (upper bound, cumulative count) pairs of the buckets'''
+        total = 0
+        pairs = []
+
+        for bound, bucket_count in zip((*self.buckets, float('inf')), self.counts):
+            total += bucket_count
+            pairs.append((bound, total))
+
+        return pairs
+
+    def quantile(self, fraction):
+        '''Estimate and return the quantile as the upper bound of the bucket it falls in'''
+        for bound, total in self.cumulative():
+            if total >= fraction * self.count:
+                return bound if bound != float('inf') else self.buckets[-1]
+
+        return 0.0
+
+histograms = {}
+counters = Counter()
+gauges = {}
+
+def key(metric, labels):
+    '''Return the key of the metric with the labels'''
+    return metric, tuple(sorted(labels.items()))
+
+def observe(metric, value, **labels):
+    '''Observe the value in the histogram of the metric with the labels'''
+    metric_key = key(metric, labels)
+
+    if (histogram := histograms.get(metric_key)) is None:
+        histogram = histograms[metric_key] = Histogram()
+
+    histogram.observe(value)
+
+def count(metric, amount=1, **labels):
+    '''Add the amount to the counter of the metric with the labels'''
+    counters[key(metric, labels)] += amount
+
+def gauge(metric, function, **labels):
+    '''Register the function returning the current value of the gauge of the metric'''
+    gauges[key(metric, labels)] = function
+
+@contextmanager
+def timer(metric, **labels):
+    '''Observe how many seconds the block takes in the histogram of the metric with the labels'''
+    start = perf_counter()
+
+    try:
+        yield
+    finally:
+        observe(metric, perf_counter() - start, **labels)
+
+def render(labels, extra=()):
+    '''Render and return the labels in the Prometheus text format'''
+    pairs = [
+        (label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for label, value in (*labels, *extra)
+    ]
+    return '{' + ','.join(f'{label}="{value}"' for label, value in pairs) + '}' if pairs else ''
+
+def exposition():
+    '''Return every metric in the Prometheus text format'''
+    lines = []
+    typed = set()
+
+    def declare(metric, kind):
+        '''Declare the type of the metric before its first sample'''
+        if metric not in typed:
+            typed.add(metric)
+            lines.append(f'# TYPE {PREFIX}_{metric} {kind}')
+
+    for (metric, labels), histogram in sorted(histograms.items()):
+        declare(metric, 'histogram')
+
+        for bound, total in histogram.cumulative():
+            le = '+Inf' if bound == float('inf') else bound
+            lines.append(f'{PREFIX}_{metric}_bucket{render(labels, (("le", le),))} {total}')
+
+        lines.append(f'{PREFIX}_{metric}_sum{render(labels)} {histogram.sum}')
+        lines.append(f'{PREFIX}_{metric}_count{render(labels)} {histogram.count}')
+
+    for (metric, labels), total in sorted(counters.items()):
+        declare(metric, 'counter')
+        lines.append(f'{PREFIX}_{metric}{render(labels)} {total}')
+
+    for (metric, labels), function in sorted(gauges.items(), key=lambda item: item[0]):
+        declare(metric, 'gauge')
+        lines.append(f'{PREFIX}_{metric}{render(labels)} {function()}')
+
+    return '\n'.join(lines) + '\n'
+
+def name(metric, labels):
+    '''Return a short name of the metric with the labels'''
+    return ' '.join((metric.removesuffix('_seconds'), *(str(value) for _, value in labels)))
+
+def summary():
+    '''Summarise the metrics and return the summary'''
+    lines = []
+
+    for (metric, labels), histogram in sorted(histograms.items()):
+        lines.append(
+            f'{name(metric, labels):<28} p50 {histogram.quantile(0.5) * 1000:>8.2f}ms'
+            f'  p99 {histogram.quantile(0.99) * 1000:>8.2f}ms  n {histogram.count}'
+        )
+
+    for (metric, labels), total in sorted(counters.items()):
+        lines.append(f'{name(metric, labels):<28} {total}')
+
+    for (metric, labels), function in sorted(gauges.items(), key=lambda item: item[0]):
+        lines.append(f'{name(metric, labels):<28} {function():.3f}')
+
+    return '\n'.join(lines) or 'No metrics yet'
+
+async def lag(interval=0.5):
+    '''Observe the lag of the event loop forever'''
+    while True:
+        start = monotonic()
+        await asyncio.sleep(interval)
+        observe('loop_lag_seconds', monotonic() - start - interval)
+
+async def handle(_):
+    '''Respond with the metrics'''
+    return web.Response(text=exposition(), content_type='text/plain', charset='utf-8')
+
+@dataclass
+class Monitor:
+    '''Storage of the lag monitor task and the endpoint runner'''
+    task : asyncio.Task = None
+    runner : web.AppRunner = None
+
+async def monitor(port=None, host='127.0.0.1'):
+    '''Start monitoring the event loop lag and serve the metrics on the port (if any), once'''
+    if Monitor.task is None:
+        Monitor.task = asyncio.create_task(lag())
+
+    if port and Monitor.runner is None:
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+
+        Monitor.runner = web.AppRunner(app)
+        await Monitor.runner.setup()
+        await web.TCPSite(Monitor.runner, host, port).start()
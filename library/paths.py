@@ -1,2 +1,7 @@
 '''Paths for persistent data files'''
+BRANDS = 'brands.txt'
+LEGITIMATE = 'legitimate.txt'
 DATABASE = 'database/database'
+LINKS = 'database/links.json'
+MIGRATIONS = 'migrations'
+THREATS = 'database/threats'
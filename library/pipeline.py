@@ -0,0 +1,68 @@
+'''Cost-ordered pipelines of detection stages'''
+from asyncio import FIRST_COMPLETED, ensure_future, wait
+from dataclasses import dataclass
+from enum import Enum
+from typing import Callable
+
+from library import metrics
+
+COSTS = Enum('COSTS', 'LOCAL NETWORK')
+
+@dataclass
+class Stage:
+    '''A detection stage, its cost, whether to report its catches and how often it ran and fired'''
+    name : str
+    cost : COSTS
+    check : Callable
+    report : bool = False
+    runs : int = 0
+    fires : int = 0
+
+    async def run(self, context):
+        '''Run the check on the context and return whether it fired'''
+        self.runs += 1
+        with metrics.timer('stage_seconds', stage=self.name):
+            fired = bool(await self.check(context))
+        self.fires += fired
+
+        return fired
+
+class Pipeline:
+    '''
+    Stages run cheapest first: local stages one by one until one fires,
+    then network stages concurrently until one fires
+    '''
+    def __init__(self, stages):
+        '''Initialize a pipeline of the stages (in order within each cost)'''
+        self.stages = sorted(stages, key=lambda stage: stage.cost.value)
+
+    async def run(self, context):
+        '''Run the stages on the context and return the first which fired (or None)'''
+        for stage in self.stages:
+            if stage.cost == COSTS.LOCAL and await stage.run(context):
+                return stage
+
+        tasks = {
+            ensure_future(stage.run(context)) : stage
+            for stage in self.stages if stage.cost == COSTS.NETWORK
+        }
+        pending = set(tasks)
+
+        try:
+            while pending:
+                done, pending = await wait(pending, return_when=FIRST_COMPLETED)
+
+                for task, stage in tasks.items(): # in order, should several finish together
+                    if task in done and task.result():
+                        return stage
+
+            return None
+        finally:
+            if pending: # the remaining lookups were cut short, so a clean verdict is incomplete
+                context.complete = False
+                for task in pending:
+                    task.cancel()
+
+    def stats(self):
+        '''Return how often each stage ran and fired'''
+        return {stage.name : (stage.runs, stage.fires) for stage in self.stages}
@@ -1,14 +1,88 @@
-'''Transient management of scam message reports'''
-log = []
+'''Management of scam message reports, clustered by domain'''
+from collections import OrderedDict
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+from tldextract import extract
+
+from library import db
+from library.domains import normalise
+from library.urls import findlinks
+
+CAPACITY = 1000 # reports kept before the oldest are evicted
+
+@dataclass(slots=True)
+class Report:
+    '''The first message reported for a domain and how often the domain was reported'''
+    message : str
+    count : int = 1
+
+def keys(message):
+    '''Return the registered domains of the URLs in the message, or the message if it has none'''
+    hosts = (normalise(urlparse(link.url).netloc) for link in findlinks(message)[1])
+    domains = {extract(host).registered_domain or host for host in hosts}
+
+    return domains or {message}
+
+class Reports:
+    '''
+    Reports in the order they were first made, indexed by domain so a repeat only counts,
+    capped by evicting the oldest and persisted to the database
+    '''
+    def __init__(self, capacity=CAPACITY):
+        '''Initialize an empty store holding at most capacity reports'''
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    def restore(self):
+        '''Restore the reports from the database'''
+        for key, message, count in db.getreports():
+            self.entries[key] = Report(message, count)
+
+    async def add(self, message):
+        '''Report the message under each of its domains'''
+        for key in keys(message):
+            if report := self.entries.get(key):
+                report.count += 1
+            else:
+                report = self.entries[key] = Report(message)
+
+            await db.putreport(key, report.message, report.count)
+
+        while len(self.entries) > self.capacity:
+            key, _ = self.entries.popitem(last=False)
+            await db.deletereport(key)
+
+    async def pop(self):
+        '''Remove and return the oldest domain with its report (or None if there are none)'''
+        if not self.entries:
+            return None
+
+        key, report = self.entries.popitem(last=False)
+        await db.deletereport(key)
+
+        return key, report
+
+reports = Reports()
+
+def restore():
+    '''Restore the reports from the database'''
+    reports.restore()
 
 async def reportmessage(message):
     '''Log an alleged scam message'''
-    if message and message not in log:
-        log.append(message)
+    if message:
+        await reports.add(message)
 
 async def getreport():
     '''Return the next report'''
-    if not log:
+    if not (entry := await reports.pop()):
         return 'None'
 
-    return log.pop(0)
+    key, report = entry
+    times = f'reported {report.count} {"time" if report.count == 1 else "times"}'
+
+    if report.message == key: # a message without domains
+        return f'Message ({times})\n```\n{report.message.replace("`", "")[:1800]}```'
+
+    return f'**{key}** ({times})\n```\n{report.message.replace("`", "")[:1800]}```'
@@ -1,34 +1,182 @@
 '''HTTP requests'''
 import asyncio
+from dataclasses import dataclass
+from ipaddress import ip_address
+import socket
 from urllib.parse import urlparse
 
 import aiohttp
+from yarl import URL
 
-async def scamlinks():
-    '''Retrieve and return the scam links or None on failure'''
-    source = 'https://raw.githubusercontent.com/Discord-AntiScam/scam-links/main/list.txt'
+from library import metrics
+from library.cache import TTLCache
+from library.domains import VERDICTS, lookup, normalise
 
-    async with aiohttp.ClientSession(raise_for_status=True) as client:
-        try:
-            async with client.get(source) as response:
-                return await response.text()
-        except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.TimeoutError):
-            return None
+SCAMLINKS = 'https://raw.githubusercontent.com/Discord-AntiScam/scam-links/main/list.txt'
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+REDIRECT_TIMEOUT = 8
+FAILURE_TTL = 300
+
+redirects = TTLCache(10000, 3600)
+metrics.gauge('cache_hit_ratio', redirects.hitrate, cache='redirects')
+resolving = {}
+
+def public(address):
+    '''Determine and return whether the IP address is globally reachable'''
+    try:
+        return ip_address(address).is_global
+    except ValueError: # scoped or malformed
+        return False
+
+class PublicResolver(aiohttp.ThreadedResolver):
+    '''A resolver refusing hosts with any address which is not globally reachable'''
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        '''Resolve and return the addresses of the host, unless one of them is not global'''
+        addresses = await super().resolve(host, port, family)
+
+        if not all(public(address['host']) for address in addresses):
+            raise OSError(f'{host} resolves to an address which is not global')
+
+        return addresses
+
+@dataclass
+class Client:
+    '''Storage of the long-lived HTTP client session'''
+    session : aiohttp.ClientSession = None
+
+async def session():
+    '''Get and return the long-lived client session, opening it when needed'''
+    if Client.session is None or Client.session.closed:
+        Client.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100, limit_per_host=4, resolver=PublicResolver()
+            )
+        )
 
-async def unshorten(client, url):
-    '''Unshorten and return the URL via the client'''
-    shorteners = {'7r6.com', 'bit.ly', 'goo.su', 'rb.gy', 'shorturl.at', 'u.to'}
+    return Client.session
 
-    if urlparse(url).netloc not in shorteners:
-        return url
+async def post(url, key, payload, timeout):
+    '''Post the JSON payload to the Google API URL with the key and return the JSON response'''
+    client = await session()
+
+    async with client.post(
+        url,
+        params={'key' : key},
+        json=payload,
+        raise_for_status=True,
+        timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as response:
+        return await response.json()
+
+async def close():
+    '''Close the long-lived client session'''
+    if Client.session is not None:
+        await Client.session.close()
+
+async def scamlinks(etag=None, modified=None):
+    '''
+    Retrieve and return the scam links with their ETag and Last-Modified validators,
+    no links if they are unchanged since the validators, or None on failure
+    '''
+    conditions = {'If-None-Match' : etag, 'If-Modified-Since' : modified}
 
     try:
-        async with client.head(url, allow_redirects=True, timeout=8) as response:
-            return response.url.human_repr()
+        client = await session()
+        async with client.get(
+            SCAMLINKS,
+            headers={header : value for header, value in conditions.items() if value},
+            raise_for_status=True,
+            timeout=aiohttp.ClientTimeout(total=60)
+        ) as response:
+            if response.status == 304: # not modified
+                return None, etag, modified
+
+            return (
+                await response.text(),
+                response.headers.get('ETag'),
+                response.headers.get('Last-Modified')
+            )
     except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.TimeoutError):
-        return url
+        return None
+
+def resolvable(url):
+    '''Determine and return whether the redirects of the URL should be followed'''
+    try:
+        host = urlparse(url).hostname
+    except ValueError: # malformed
+        return False
+
+    if not host or '.' not in host:
+        return False
+
+    try:
+        ip_address(host)
+    except ValueError: # not an IP address, whose addresses the resolver screens
+        return lookup(normalise(host)) == VERDICTS.UNKNOWN
+
+    return public(host)
+
+async def follow(url):
+    '''
+    Follow the redirect chain of the URL and return its final URL,
+    stopping at the first hop which should not be followed
+    '''
+    client = await session()
+
+    for _ in range(MAX_REDIRECTS):
+        if not resolvable(url):
+            break
+
+        async with client.head(
+            url,
+            allow_redirects=False,
+            timeout=aiohttp.ClientTimeout(total=REDIRECT_TIMEOUT)
+        ) as response:
+            location = response.headers.get('Location')
+
+            if response.status not in REDIRECT_STATUSES or not location:
+                break
+
+            url = response.url.join(URL(location)).human_repr()
+
+    return url
+
+async def unshorten(url):
+    '''Unshorten and return the URL, caching the result (or the failure to resolve it)'''
+    final = redirects.get(url)
+
+    if final is None:
+        try:
+            final = await follow(url)
+            redirects.put(url, final)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            final = url
+            redirects.put(url, final, FAILURE_TTL)
+
+    return final
+
+def resolve(url):
+    '''Get and return the task unshortening the URL, starting one if none is in flight'''
+    if url not in resolving:
+        resolving[url] = asyncio.create_task(unshorten(url))
+        resolving[url].add_done_callback(lambda task: resolving.pop(url, None))
+
+    return resolving[url]
+
+async def redirect(urls, budget=8):
+    '''
+    Unshorten and return the URLs concurrently, keeping those unresolved within the budget,
+    and whether every URL was resolved within it
+    '''
+    tasks = {url : resolve(url) for url in urls if resolvable(url)}
+
+    if not tasks:
+        return set(urls), True
+
+    with metrics.timer('call_seconds', call='redirect'):
+        done, pending = await asyncio.wait(tasks.values(), timeout=budget)
 
-async def redirect(urls):
-    '''Unshorten and return the URLs'''
-    async with aiohttp.ClientSession(raise_for_status=True) as client:
-        return {await unshorten(client, url) for url in urls}
+    return {url for url in urls if url not in tasks} | {
+        task.result() if task in done else url for url, task in tasks.items()
+    }, not pending
@@ -0,0 +1,126 @@
+'''Safe Browsing Lookup API client'''
+import asyncio
+from contextlib import suppress
+
+import aiohttp
+
+from library import metrics, requester
+from library.cache import TTLCache
+
+class SafeBrowsing:
+    '''
+    A Safe Browsing client which caches verdicts per URL, deduplicates in-flight lookups
+    and coalesces the lookups of concurrent messages into batched requests
+    '''
+    threat_types = (
+        'MALWARE',
+        'SOCIAL_ENGINEERING',
+        'THREAT_TYPE_UNSPECIFIED',
+        'UNWANTED_SOFTWARE',
+        'POTENTIALLY_HARMFUL_APPLICATION'
+    )
+    window = 0.05 # seconds to wait for more lookups before sending a batch
+    batchsize = 500 # maximum URLs per request
+    negative_ttl = 300 # seconds to cache URLs which are not matches
+    timeout = 5
+
+    def __init__(self, endpoint='https://safebrowsing.googleapis.com/v4/threatMatches:find'):
+        '''Initialize the client for the endpoint'''
+        self.endpoint = endpoint
+        self.verdicts = TTLCache(100000, self.negative_ttl)
+        self.pending = {}
+        self.batch = []
+        self.timer = None
+        self.tasks = set()
+
+    async def lookup(self, urls, key):
+        '''
+        Look up the URLs and return whether any of them is malicious,
+        or None if none is but some could not be looked up
+        '''
+        futures = []
+
+        for url in set(urls):
+            verdict = self.verdicts.get(url)
+
+            if verdict:
+                return True
+            if verdict is None:
+                futures.append(self.pending.get(url) or self.enqueue(url, key))
+
+        # shielded, as other lookups may be waiting on the same futures
+        verdicts = await asyncio.gather(*map(asyncio.shield, futures))
+
+        if any(verdicts):
+            return True
+
+        return None if None in verdicts else False
+
+    def enqueue(self, url, key):
+        '''Add the URL to the next batch and return the future of its verdict'''
+        future = asyncio.get_running_loop().create_future()
+        self.pending[url] = future
+        self.batch.append(url)
+
+        if len(self.batch) >= self.batchsize:
+            self.flush(key)
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush, key)
+
+        return future
+
+    def flush(self, key):
+        '''Send the current batch'''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.batch = self.batch, []
+
+        task = asyncio.create_task(self.send(batch, key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, batch, key):
+        '''Request the verdicts of the batch, resolving and caching them'''
+        payload = {
+            'client' : {'clientId' : 'asca', 'clientVersion' : '1.0'},
+            'threatInfo' : {
+                'threatTypes' : self.threat_types,
+                'platformTypes' : ['ANY_PLATFORM'],
+                'threatEntryTypes' : ['URL'],
+                'threatEntries' : [{'url' : url} for url in batch]
+            }
+        }
+
+        durations = None # seconds to cache each match, or None on failure
+        try:
+            response = await requester.post(self.endpoint, key, payload, self.timeout)
+            durations = self.durations(response.get('matches', []))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, AttributeError, TypeError):
+            pass # failed, or answered with a malformed response
+        finally: # whatever went wrong, nothing may wait on the batch forever
+            for url in batch:
+                malicious = None if durations is None else url in durations
+
+                if durations is not None: # failures are not cached
+                    self.verdicts.put(url, malicious, durations.get(url))
+
+                future = self.pending.pop(url, None)
+                if future is not None and not future.done():
+                    future.set_result(malicious)
+
+    def durations(self, matches):
+        '''Return the seconds to cache each matched URL for'''
+        durations = {}
+
+        for match in matches:
+            url = match.get('threat', {}).get('url')
+            with suppress(AttributeError, ValueError):
+                durations[url] = float(match.get('cacheDuration').rstrip('s'))
+            durations.setdefault(url, self.negative_ttl)
+
+        return durations
+
+safebrowsing = SafeBrowsing()
+metrics.gauge('cache_hit_ratio', safebrowsing.verdicts.hitrate, cache='safebrowsing')
@@ -0,0 +1,143 @@
+'''Per guild scheduling of moderation actions'''
+import asyncio
+from collections import deque
+from contextlib import suppress
+from enum import Enum
+from itertools import count
+import logging
+from time import monotonic, time
+
+from discord import Forbidden, HTTPException, NotFound, Object
+
+from library import metrics
+
+PRIORITIES = Enum('PRIORITIES', 'PUNISHMENT CLEANUP')
+BULK_SIZE = 100
+BULK_AGE = 14 * 24 * 60 * 60 - 60 # Discord only bulk deletes messages younger than 14 days
+
+def batches(records, now):
+    '''
+    Split the records into batches which can be bulk deleted
+    and return them with the IDs of the messages too old to be
+    '''
+    recent = sorted(record.id for record in records if now - record.time < BULK_AGE)
+    old = [record.id for record in records if now - record.time >= BULK_AGE]
+
+    return [recent[start:start + BULK_SIZE] for start in range(0, len(recent), BULK_SIZE)], old
+
+def percentile(samples, fraction):
+    '''Return the fraction percentile of the sorted samples (or 0 if there are none)'''
+    return samples[min(int(fraction * len(samples)), len(samples) - 1)] if samples else 0.0
+
+async def purge(channel, records, denied=None):
+    '''
+    Delete the recorded messages of the channel in as few requests as possible,
+    passing the newest to the denied coroutine (if any) when not allowed to
+    '''
+    bulk, single = batches(records, time())
+
+    try:
+        for batch in bulk:
+            try:
+                await channel.delete_messages([Object(id=message) for message in batch])
+            except NotFound: # a single message which was already deleted
+                pass
+            except Forbidden: # not allowed to delete any
+                raise
+            except HTTPException: # some messages were too old, delete them one by one
+                single.extend(batch)
+
+        for message in single:
+            with suppress(NotFound):
+                await channel.get_partial_message(message).delete()
+    except Forbidden:
+        if denied:
+            await denied(channel.get_partial_message(max(record.id for record in records)))
+
+class Scheduler:
+    '''
+    A queue of moderation actions per guild, run by a worker per guild in order of priority,
+    leaving rate limits to the per-route buckets of the Discord client
+    '''
+    def __init__(self, samples=1000):
+        '''Initialize the scheduler, keeping the last samples times to clean'''
+        self.queues = {}
+        self.workers = {}
+        self.sequence = count()
+        self.durations = deque(maxlen=samples)
+
+    def schedule(self, guild, priority, action, *arguments):
+        '''Queue the action of the guild and return a future of its result'''
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.setdefault(guild, asyncio.PriorityQueue())
+        queue.put_nowait(
+            (priority.value, next(self.sequence), priority, monotonic(), action, arguments, future)
+        )
+
+        if guild not in self.workers:
+            self.workers[guild] = asyncio.create_task(self.work(guild))
+
+        return future
+
+    async def work(self, guild):
+        '''Run the queued actions of the guild until none are left'''
+        queue = self.queues[guild]
+
+        while not queue.empty():
+            *_, priority, queued, action, arguments, future = queue.get_nowait()
+
+            try:
+                with metrics.timer('action_seconds', action=priority.name.lower()):
+                    result = await action(*arguments)
+            except Exception as error: # pylint: disable=broad-exception-caught
+                if not future.cancelled():
+                    future.set_exception(error)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+            if priority == PRIORITIES.CLEANUP:
+                self.durations.append(monotonic() - queued)
+                metrics.observe('clean_seconds', self.durations[-1])
+                logging.getLogger(__name__).info(
+                    'Cleaned a channel of guild %d in %.1fs (%d actions queued)',
+                    guild, self.durations[-1], queue.qsize()
+                )
+
+        del self.queues[guild], self.workers[guild]
+
+    async def perform(self, guild, action, *arguments):
+        '''Perform the punishment of the guild ahead of its cleanups and return its result'''
+        return await self.schedule(guild, PRIORITIES.PUNISHMENT, action, *arguments)
+
+    def cleanup(self, guild, records, denied=None):
+        '''
+        Queue the deletion of the recorded messages of the guild, channel by channel,
+        passing the newest of a channel to the denied coroutine (if any) when not allowed to
+        '''
+        channels = {}
+
+        for record in records:
+            channels.setdefault(record.channel, []).append(record)
+
+        for channel, channel_records in channels.items():
+            if channel := guild.get_channel_or_thread(channel):
+                self.schedule(
+                    guild.id, PRIORITIES.CLEANUP, purge, channel, channel_records, denied
+                )
+
+    def stats(self):
+        '''Return the queued actions, the deepest queue and the percentiles of the times to clean'''
+        depths = [queue.qsize() for queue in self.queues.values()]
+        durations = sorted(self.durations)
+
+        return {
+            'queued' : sum(depths),
+            'deepest' : max(depths, default=0),
+            'clean_p50' : percentile(durations, 0.5),
+            'clean_p99' : percentile(durations, 0.99)
+        }
+
+scheduler = Scheduler()
+metrics.gauge('queue_depth', lambda: scheduler.stats()['queued'])
+metrics.gauge('deepest_queue', lambda: scheduler.stats()['deepest'])
@@ -0,0 +1,354 @@
+'''Local Safe Browsing hash-prefix database synced via the Update API'''
+import asyncio
+from base64 import b64decode, b64encode
+from contextlib import suppress
+from hashlib import sha256
+from ipaddress import ip_address
+import json
+from mmap import mmap, ACCESS_READ
+import os
+from pathlib import Path
+from re import compile as regex
+from time import monotonic
+from urllib.parse import unquote_to_bytes
+
+import aiohttp
+
+from library import metrics, requester
+from library.cache import TTLCache
+from library.paths import THREATS
+
+LISTS = ('MALWARE', 'SOCIAL_ENGINEERING', 'UNWANTED_SOFTWARE')
+PREFIX_SIZE = 4
+DOTS = regex(r'\.{2,}')
+
+def unescape(url):
+    '''Percent-unescape the URL until it no longer changes and return it (one char per byte)'''
+    raw = url.encode('utf-8')
+
+    while (unescaped := unquote_to_bytes(raw)) != raw:
+        raw = unescaped
+
+    return raw.decode('latin-1')
+
+def escape(text):
+    '''Percent-escape the control, space, non-ASCII, # and % characters of the text and return it'''
+    return ''.join(
+        f'%{byte:02X}' if byte <= 32 or byte >= 127 or byte in b'#%' else chr(byte)
+        for byte in text.encode('latin-1')
+    )
+
+def resolve(path):
+    '''Resolve the ./ and ../ segments of the path, collapse repeated slashes and return it'''
+    segments = []
+
+    for segment in path.split('/'):
+        if segment == '..':
+            if segments:
+                segments.pop()
+        elif segment not in {'.', ''}:
+            segments.append(segment)
+
+    trailing = segments and path.endswith(('/', '/.', '/..'))
+    return '/' + '/'.join(segments) + ('/' if trailing else '')
+
+def canonical(url):
+    '''Canonicalise and return the URL as specified by Safe Browsing'''
+    url = unescape(url.strip().replace('\t', '').replace('\r', '').replace('\n', '').split('#')[0])
+
+    scheme, separator, rest = url.partition('://')
+    if not separator:
+        scheme, rest = 'http', url
+
+    authority_end = min(
+        (position for position in (rest.find('/'), rest.find('?')) if position != -1),
+        default=len(rest)
+    )
+    authority, rest = rest[:authority_end], rest[authority_end:]
+    path, separator, query = rest.partition('?')
+
+    host = authority.rpartition('@')[2]
+    if not host.startswith('['):
+        host = host.partition(':')[0]
+    host = DOTS.sub('.', host.strip('.')).lower()
+
+    query = f'?{escape(query)}' if separator else ''
+    return f'{scheme.lower()}://{escape(host)}{escape(resolve(path))}{query}'
+
+def expressions(url):
+    '''Return the host suffix / path prefix expressions of the canonical URL to look up'''
+    host, _, path = url.partition('://')[2].partition('/')
+    path, separator, query = f'/{path}'.partition('?')
+
+    hosts = [host]
+    with suppress(ValueError):
+        ip_address(host.strip('[]'))
+        host = None
+
+    if host:
+        components = host.split('.')
+        hosts.extend(
+            '.'.join(components[-count:]) for count in range(min(5, len(components) - 1), 1, -1)
+        )
+
+    paths = [f'{path}?{query}'] if separator else []
+    paths.append(path)
+
+    segments = path.split('/')[1:-1]
+    paths.extend('/' + ''.join(f'{segment}/' for segment in segments[:count]) for count in range(4))
+
+    return list(dict.fromkeys(f'{host}{path}' for host in hosts for path in paths))
+
+def fullhashes(urls):
+    '''Return the full SHA256 hashes of every expression of the URLs'''
+    return {sha256(expression.encode('latin-1')).digest()
+            for url in urls for expression in expressions(canonical(url))}
+
+class Prefixes:
+    '''A sorted array of 4-byte hash prefixes in a memory-mapped file'''
+    def __init__(self, path):
+        '''Map the file at the path (an absent or empty file holds no prefixes)'''
+        self.map = None
+
+        with suppress(FileNotFoundError, ValueError):
+            with open(path, mode='rb') as prefixes_file:
+                self.map = mmap(prefixes_file.fileno(), 0, access=ACCESS_READ)
+
+    def __len__(self):
+        return len(self.map) // PREFIX_SIZE if self.map else 0
+
+    def __getitem__(self, index):
+        return self.map[index * PREFIX_SIZE:(index + 1) * PREFIX_SIZE]
+
+    def __contains__(self, prefix):
+        low, high = 0, len(self)
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self[middle] < prefix:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low < len(self) and self[low] == prefix
+
+    def close(self):
+        '''Unmap the file'''
+        if self.map:
+            self.map.close()
+
+def replace(path, data):
+    '''Atomically replace the file at the path with the data'''
+    temporary = path.with_name(f'{path.name}.tmp')
+    temporary.write_bytes(data)
+    os.replace(temporary, path)
+
+def read_full(path):
+    '''Read and return the complete (variable length) sorted prefix list stored at the path'''
+    with suppress(FileNotFoundError):
+        data = path.read_bytes()
+        prefixes = []
+        position = 0
+
+        while position < len(data):
+            size = data[position]
+            prefixes.append(data[position + 1:position + 1 + size])
+            position += 1 + size
+
+        return prefixes
+
+    return []
+
+def apply(prefixes, update):
+    '''Apply the list update to the sorted prefixes and return them, verifying the checksum'''
+    if update.get('responseType') == 'FULL_UPDATE':
+        prefixes = []
+
+    removals = {
+        index
+        for removal in update.get('removals', ())
+        for index in removal.get('rawIndices', {}).get('indices', ())
+    }
+    prefixes = [prefix for index, prefix in enumerate(prefixes) if index not in removals]
+
+    for addition in update.get('additions', ()):
+        size = addition['rawHashes']['prefixSize']
+        data = b64decode(addition['rawHashes']['rawHashes'])
+        prefixes.extend(data[position:position + size] for position in range(0, len(data), size))
+
+    prefixes.sort()
+
+    if sha256(b''.join(prefixes)).digest() != b64decode(update['checksum']['sha256']):
+        raise ValueError('Checksum mismatch')
+
+    return prefixes
+
+def duration(text, default=0.0):
+    '''Parse and return a duration such as "300.5s" in seconds'''
+    try:
+        return float(text.rstrip('s'))
+    except (AttributeError, ValueError):
+        return default
+
+class ThreatDatabase:
+    '''
+    A local copy of the Safe Browsing hash-prefix lists,
+    only asking the API for full hashes when a URL matches a local prefix
+    '''
+    client = {'clientId' : 'asca', 'clientVersion' : '1.0'}
+    timeout = 30
+
+    def __init__(self, directory=THREATS, endpoint='https://safebrowsing.googleapis.com/v4/'):
+        '''Initialize the database stored in the directory, syncing via the endpoint'''
+        self.directory = Path(directory)
+        self.endpoint = endpoint
+        self.lists = {}
+        self.states = {}
+        self.positives = TTLCache(100000, 300)
+        self.negatives = TTLCache(100000, 300)
+        self.next_sync = 0.0
+
+    def load(self):
+        '''Map the stored lists and read their client states'''
+        with suppress(FileNotFoundError, ValueError):
+            self.states = json.loads((self.directory / 'states.json').read_text(encoding='utf-8'))
+
+        for name in LISTS:
+            self.lists[name] = Prefixes(self.directory / f'{name}.prefixes')
+
+    def ready(self):
+        '''Return whether any list holds prefixes'''
+        return any(self.lists.values())
+
+    def threatinfo(self, entries):
+        '''Return the threat info of a request for the entries'''
+        return {
+            'threatTypes' : LISTS,
+            'platformTypes' : ['ANY_PLATFORM'],
+            'threatEntryTypes' : ['URL'],
+            'threatEntries' : entries
+        }
+
+    async def post(self, method, key, payload):
+        '''Post the payload to the API method and return the response'''
+        return await requester.post(f'{self.endpoint}{method}', key, payload, self.timeout)
+
+    def store(self, name, update):
+        '''Apply the update to the stored list and return its new prefixes (blocking)'''
+        full = self.directory / f'{name}.full'
+        prefixes = apply(read_full(full), update)
+
+        replace(full, b''.join(bytes((len(prefix),)) + prefix for prefix in prefixes))
+        replace(
+            self.directory / f'{name}.prefixes',
+            b''.join(dict.fromkeys(prefix[:PREFIX_SIZE] for prefix in prefixes))
+        )
+
+        return Prefixes(self.directory / f'{name}.prefixes')
+
+    async def sync(self, key):
+        '''Fetch and apply the list updates, unless the API asked to wait longer'''
+        if monotonic() < self.next_sync:
+            return
+
+        try:
+            response = await self.post('threatListUpdates:fetch', key, {
+                'client' : self.client,
+                'listUpdateRequests' : [
+                    {
+                        'threatType' : name,
+                        'platformType' : 'ANY_PLATFORM',
+                        'threatEntryType' : 'URL',
+                        'state' : self.states.get(name, ''),
+                        'constraints' : {'supportedCompressions' : ['RAW']}
+                    }
+                    for name in LISTS
+                ]
+            })
+            wait = duration(response.get('minimumWaitDuration'))
+            updates = [update for update in response.get('listUpdateResponses', ())
+                       if update.get('threatType') in LISTS]
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, AttributeError, TypeError):
+            self.next_sync = monotonic() + 60 # failed, or answered with a malformed response
+            return
+
+        self.next_sync = monotonic() + wait
+        self.directory.mkdir(parents=True, exist_ok=True)
+        loop = asyncio.get_running_loop()
+
+        for update in updates:
+            name = update['threatType']
+
+            try:
+                prefixes = await loop.run_in_executor(None, self.store, name, update)
+            except (KeyError, ValueError, AttributeError, TypeError): # corrupt, ask for it in full
+                self.states.pop(name, None)
+                continue
+
+            previous, self.lists[name] = self.lists.get(name), prefixes
+            self.states[name] = update.get('newClientState', '')
+
+            if previous:
+                previous.close()
+
+        replace(self.directory / 'states.json', json.dumps(self.states).encode('utf-8'))
+
+    async def confirm(self, prefixes, key):
+        '''
+        Request the full hashes of the prefixes, cache them
+        and return the malicious ones (or None on failure)
+        '''
+        try:
+            response = await self.post('fullHashes:find', key, {
+                'client' : self.client,
+                'clientStates' : list(self.states.values()),
+                'threatInfo' : self.threatinfo(
+                    [{'hash' : b64encode(prefix).decode('ascii')} for prefix in prefixes]
+                )
+            })
+            matches = list(response.get('matches', ()))
+            negative_ttl = duration(response.get('negativeCacheDuration'), 300)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, AttributeError, TypeError):
+            return None # failed, or answered with a malformed response
+
+        malicious = set()
+        for match in matches:
+            with suppress(KeyError, ValueError, TypeError):
+                fullhash = b64decode(match['threat']['hash'])
+                malicious.add(fullhash)
+                self.positives.put(fullhash, True, duration(match.get('cacheDuration'), 300))
+
+        for prefix in prefixes:
+            self.negatives.put(prefix, True, negative_ttl)
+
+        return malicious
+
+    async def lookup(self, urls, key):
+        '''
+        Look up the URLs and return whether any of them is malicious,
+        or None if none is known to be but some could not be confirmed
+        '''
+        candidates = {
+            fullhash for fullhash in fullhashes(urls)
+            if any(fullhash[:PREFIX_SIZE] in prefixes for prefixes in self.lists.values())
+        }
+
+        if any(self.positives.get(fullhash) for fullhash in candidates):
+            return True
+
+        unresolved = {
+            fullhash[:PREFIX_SIZE] for fullhash in candidates
+            if not self.negatives.get(fullhash[:PREFIX_SIZE])
+        }
+
+        if not unresolved:
+            return False
+
+        if (malicious := await self.confirm(unresolved, key)) is None:
+            return None
+
+        return bool(candidates & malicious)
+
+threatdb = ThreatDatabase()
+metrics.gauge('cache_hit_ratio', threatdb.negatives.hitrate, cache='threatlist')
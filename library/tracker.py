@@ -0,0 +1,99 @@
+'''Sliding-window tracking of repeated messages'''
+from collections import OrderedDict
+from dataclasses import dataclass
+from hashlib import blake2b
+from time import time
+
+@dataclass(slots=True, frozen=True)
+class Record:
+    '''A compact record of a tracked message'''
+    id : int
+    channel : int
+    time : float
+
+def keys(message):
+    '''Return the keys a message is tracked under: its content and its stickers'''
+    guild, author = message.guild.id, message.author.id
+    found = []
+
+    if message.content:
+        found.append((guild, author, blake2b(message.content.encode(), digest_size=16).digest()))
+    if message.stickers:
+        found.append((guild, author, tuple(sticker.id for sticker in message.stickers)))
+
+    return found
+
+class Tracker:
+    '''
+    Per (guild, author, content or stickers) bounded buffers of recent messages,
+    answering how often a message was repeated and which copies to prune
+    '''
+    def __init__(self, retention=120, maxlen=64, maxkeys=20000):
+        '''
+        Initialize a tracker keeping at most maxlen records per key for retention seconds,
+        and at most maxkeys keys, evicting the least recently touched
+        '''
+        self.retention = retention
+        self.maxlen = maxlen
+        self.maxkeys = maxkeys
+        self.buffers = OrderedDict()
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def expire(self, now):
+        '''Drop the records and keys older than the retention, and the keys beyond the cap'''
+        horizon = now - self.retention
+
+        while len(self.buffers) > self.maxkeys:
+            self.buffers.popitem(last=False)
+
+        while self.buffers:
+            key, buffer = next(iter(self.buffers.items()))
+
+            # buffers are short lists, as most keys only ever hold one record
+            live = next((i for i, record in enumerate(buffer) if record.time >= horizon), None)
+            if live is not None:
+                del buffer[:live]
+                break
+
+            del self.buffers[key]
+
+    def track(self, message):
+        '''Record the message'''
+        now = time()
+        record = Record(message.id, message.channel.id, message.created_at.timestamp())
+
+        for key in keys(message):
+            buffer = self.buffers.setdefault(key, [])
+
+            if all(tracked.id != record.id for tracked in buffer):
+                buffer.append(record)
+                del buffer[:-self.maxlen]
+
+            self.buffers.move_to_end(key)
+
+        self.expire(now)
+
+    def repeats(self, message, window=10):
+        '''Return how many copies of the message were sent within the window (in seconds)'''
+        horizon = time() - window
+
+        return max(
+            (
+                sum(record.time > horizon for record in self.buffers.get(key, ()))
+                for key in keys(message)
+            ),
+            default=0
+        )
+
+    def prunable(self, message):
+        '''Remove and return the records of every tracked copy of the message'''
+        records = set()
+
+        for key in keys(message):
+            records.update(self.buffers.pop(key, ()))
+
+        return records
+
+tracker = Tracker()
@@ -0,0 +1,163 @@
+'''Detection of domains impersonating brands'''
+from contextlib import suppress
+from unicodedata import combining, normalize
+
+from tldextract import extract
+
+from library.paths import BRANDS, LEGITIMATE
+
+CONFUSABLES = str.maketrans({
+    # Cyrillic
+    'а' : 'a', 'в' : 'b', 'с' : 'c', 'ԁ' : 'd', 'е' : 'e', 'н' : 'h', 'һ' : 'h', 'і' : 'i',
+    'ј' : 'j', 'к' : 'k', 'м' : 'm', 'о' : 'o', 'р' : 'p', 'ԛ' : 'q', 'ѕ' : 's', 'т' : 't',
+    'у' : 'y', 'х' : 'x', 'ԝ' : 'w',
+    # Greek
+    'α' : 'a', 'ε' : 'e', 'ι' : 'i', 'κ' : 'k', 'ν' : 'v', 'ο' : 'o', 'ρ' : 'p', 'τ' : 't',
+    'υ' : 'u', 'χ' : 'x',
+    # digits and lookalike letters
+    '0' : 'o', '1' : 'i', '3' : 'e', '4' : 'a', '5' : 's', '7' : 't', 'l' : 'i', '|' : 'i',
+    # separators
+    '-' : None, '_' : None
+})
+SEQUENCES = (('rn', 'm'), ('vv', 'w'), ('cl', 'd'))
+
+def skeleton(label):
+    '''Reduce and return the label to a skeleton shared by the labels it can be confused with'''
+    with suppress(UnicodeError):
+        label = label.encode('ascii').decode('idna')
+
+    label = ''.join(
+        character for character in normalize('NFKD', label.casefold())
+        if not combining(character)
+    )
+
+    for sequence, replacement in SEQUENCES:
+        label = label.replace(sequence, replacement)
+
+    return label.translate(CONFUSABLES)
+
+def transpositions(first, second):
+    '''
+    Compute and return the optimal string alignment distance between the strings,
+    which counts a transposition of adjacent characters as one edit
+    '''
+    rows = [list(range(len(second) + 1))]
+
+    for row in range(1, len(first) + 1):
+        rows.append([row] + [0] * len(second))
+
+        for column in range(1, len(second) + 1):
+            cost = first[row - 1] != second[column - 1]
+            rows[row][column] = min(
+                rows[row - 1][column] + 1,
+                rows[row][column - 1] + 1,
+                rows[row - 1][column - 1] + cost
+            )
+
+            if (row > 1 and column > 1 and first[row - 1] == second[column - 2]
+                    and first[row - 2] == second[column - 1]):
+                rows[row][column] = min(rows[row][column], rows[row - 2][column - 2] + 1)
+
+    return rows[-1][-1]
+
+def tolerance(brand):
+    '''Return how many edits away from the brand a lookalike may be'''
+    if len(brand) >= 12:
+        return 2
+    if len(brand) >= 6:
+        return 1
+
+    return 0
+
+def deletions(word, depth):
+    '''Return the strings made by deleting at most depth characters from the word'''
+    found = frontier = {word}
+
+    for _ in range(depth):
+        frontier = {
+            item[:position] + item[position + 1:]
+            for item in frontier for position in range(len(item))
+        }
+        found = found | frontier
+
+    return found
+
+def read(path=BRANDS):
+    '''Read and return the brands (or domains) listed in the file at the path, one per line'''
+    with open(path, encoding='utf-8') as listed_file:
+        return [
+            line.strip().lower() for line in listed_file
+            if line.strip() and not line.startswith('#')
+        ]
+
+class Brands:
+    '''
+    A brand list indexed by the deletions of the skeletons of the brands:
+    strings within k edits (or transpositions) share a string made by deleting
+    at most k characters from each, so a lookup costs the same whatever the number of brands
+    '''
+    def __init__(self, listed=()):
+        '''Index the listed brands'''
+        self.brands = set()
+        self.skeletons = {}
+        self.index = {}
+        self.depth = 0
+
+        for brand in listed:
+            self.add(brand)
+
+    def add(self, brand):
+        '''Index the brand (the first of brands sharing a skeleton wins)'''
+        folded = skeleton(brand)
+        self.brands.add(brand)
+
+        if folded not in self.skeletons:
+            self.skeletons[folded] = brand
+            self.depth = max(self.depth, tolerance(brand))
+
+            for deletion in deletions(folded, tolerance(brand)):
+                self.index.setdefault(deletion, set()).add(folded)
+
+    def candidates(self, folded):
+        '''Find and return the skeletons which may be within the tolerance of the folded domain'''
+        return {
+            candidate
+            for deletion in deletions(folded, self.depth)
+            for candidate in self.index.get(deletion, ())
+        }
+
+    def closest(self, domain):
+        '''Find and return the closest brand the domain impersonates and its distance, or None'''
+        domain = domain.lower()
+
+        if domain in self.brands:
+            return None
+
+        folded = skeleton(domain)
+        matches = sorted(
+            (distance, self.skeletons[candidate])
+            for candidate in self.candidates(folded)
+            if (distance := transpositions(folded, candidate))
+            <= tolerance(self.skeletons[candidate])
+        )
+
+        if not matches:
+            return None
+
+        distance, brand = matches[0]
+        return brand, distance
+
+brands = Brands(read())
+legitimate = frozenset(read(LEGITIMATE))
+
+async def lookalike(host):
+    '''
+    Determine and return the closest brand the registrable domain of the host impersonates
+    and its distance from the brand, or None if it impersonates none or is known to be legitimate
+    '''
+    parts = extract(host)
+
+    if parts.registered_domain in legitimate:
+        return None
+
+    return brands.closest(parts.domain)
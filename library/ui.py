@@ -1,9 +1,8 @@
 '''UI components'''
 import discord
-from urlextract import URLExtract
 
 from library import db
-from library.detector import slash
+from library.urls import findlinks
 
 class Whitelist(discord.ui.Modal):
     '''A representation of a whitelist modal'''
@@ -22,26 +21,13 @@ class Whitelist(discord.ui.Modal):
 
     async def callback(self, interaction):
         '''Process the form submission'''
-        link_extractor = URLExtract()
-        urls = link_extractor.find_urls(
-            self.children[0].value,
-            with_schema_only=True,
-            only_unique=True
-        )
+        _, links = findlinks(self.children[0].value, schema_only=True)
+        urls = list(dict.fromkeys(link.url for link in links))
 
         if not urls:
             await interaction.response.send_message('No valid URLs found', ephemeral=True)
         else:
-            await db.clearwhitelist(interaction.guild_id)
-
-            for url in urls:
-                await db.addwhitelist(
-                    interaction.guild_id,
-                    await slash(
-                        url,
-                        {tld for tld in link_extractor._load_cached_tlds() if tld in url} # pylint: disable=protected-access
-                    )
-                )
+            await db.setwhitelist(interaction.guild_id, urls)
 
             await interaction.response.send_message(
                 'Done. Run the command again to check your whitelist.',
@@ -0,0 +1,123 @@
+'''Shared URL extraction and normalisation'''
+from asyncio import get_running_loop
+from dataclasses import dataclass
+from re import compile as regex
+
+from urlextract import URLExtract
+
+from library.matcher import Automaton
+
+TOKEN = regex(r'\S+')
+DELIMITER = regex(r'[/?#]')
+
+@dataclass(frozen=True)
+class Link:
+    '''A canonical URL and the span of its text in the normalised message'''
+    url : str
+    span : tuple
+
+def build(extractor):
+    '''Build and return an automaton of the TLDs known to the extractor'''
+    return Automaton((tld, None) for tld in extractor._load_cached_tlds()) # pylint: disable=protected-access
+
+@dataclass
+class Shared:
+    '''Storage of the process-wide URL extractor, its TLD index and how often they were refreshed'''
+    extractor : URLExtract = URLExtract()
+    tlds : Automaton = build(extractor)
+    revision : int = 0
+
+def updated(days):
+    '''Create and return an extractor whose TLD list is no older than the days'''
+    extractor = URLExtract()
+    extractor.update_when_older(days)
+
+    return extractor
+
+async def refresh(days=1):
+    '''Refresh the TLD list off the event loop and swap in the updated extractor and index'''
+    loop = get_running_loop()
+    extractor = await loop.run_in_executor(None, updated, days)
+    tlds = await loop.run_in_executor(None, build, extractor)
+
+    Shared.extractor, Shared.tlds, Shared.revision = extractor, tlds, Shared.revision + 1
+
+def reload(revision):
+    '''
+    Rebuild the extractor and index from the TLD list a refresh cached,
+    in a worker process still holding those of an older revision
+    '''
+    extractor = URLExtract()
+    Shared.extractor, Shared.tlds, Shared.revision = extractor, build(extractor), revision
+
+def protocol(url):
+    '''Add a protocol to the URL if it does not currently have one and return it'''
+    return f'https://{url}' if not url.startswith('http') else url
+
+def slash(url):
+    '''Insert a forward slash after the TLD of the URL if it has no path and return it'''
+    scheme_end = url.find(':')
+    has_authority = url.startswith('://', scheme_end) and not DELIMITER.search(url, 0, scheme_end)
+
+    if scheme_end < 1 or not has_authority:
+        return url
+
+    host_start = scheme_end + 3
+    delimiter = DELIMITER.search(url, host_start)
+    host_end = delimiter.start() if delimiter else len(url)
+
+    if delimiter and delimiter.group() == '/': # has a path
+        return url
+
+    tlds = Shared.tlds.finditer(url[host_start:host_end])
+    try:
+        start, length = max((end - len(tld), len(tld)) for end, tld, _ in tlds)
+    except ValueError: # no TLD
+        return url
+
+    position = host_start + start + length
+    return f'{url[:position]}/{url[position:]}'
+
+def slashes(message):
+    '''Insert a forward slash after the TLD of URLs without a path in a single pass and return it'''
+    pieces = []
+    position = 0
+
+    for token in TOKEN.finditer(message):
+        word = token.group()
+
+        pieces.append(message[position:token.start()])
+        pieces.append(slash(word) if word.startswith('http') else word)
+        position = token.end()
+
+    pieces.append(message[position:])
+    return ''.join(pieces)
+
+def findlinks(message, schema_only=False):
+    '''
+    Normalise the slashes of the URLs in the message
+    and return it with the canonical URLs it contains (in order, with their spans)
+    '''
+    text = slashes(message)
+
+    links = [
+        Link(protocol(url), span)
+        for url, span in Shared.extractor.find_urls(
+            text, get_indices=True, with_schema_only=schema_only
+        )
+    ]
+
+    return text, links
+
+def cut(text, links):
+    '''Remove the spans of the links from the text and return it'''
+    pieces = []
+    position = 0
+
+    for link in sorted(links, key=lambda link: link.span):
+        start, end = link.span
+        pieces.append(text[position:max(start, position)])
+        position = max(end, position)
+
+    pieces.append(text[position:])
+    return ''.join(pieces)
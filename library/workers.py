@@ -0,0 +1,121 @@
+'''A bounded pool of worker processes for CPU-bound analysis, off the event loop'''
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+from multiprocessing import get_context
+
+from library import metrics
+
+def ready():
+    '''Report that the worker is ready'''
+    return True
+
+def fork(workers):
+    '''Fork and return an executor of the workers, blocking until they are ready'''
+    # fork rather than spawn, which would rerun the bot as the main module of each worker
+    executor = ProcessPoolExecutor(workers, mp_context=get_context('fork'))
+    for started in [executor.submit(ready) for _ in range(workers)]: # fork them all now
+        started.result()
+
+    return executor
+
+class Pool:
+    '''
+    Worker processes forked from the warm bot process, so they share its extractors and indexes,
+    behind a bounded queue: submissions wait for room, and are shed if none frees up in time
+    '''
+    backlog = 8 # queued analyses per worker before submissions wait
+    patience = 0.5 # seconds a submission waits for room before it is shed
+
+    def __init__(self):
+        '''Initialize a pool running inline'''
+        self.workers = 0
+        self.executor = None
+        self.slots = None
+        self.restarting = None
+        self.pending = 0
+        self.shed = 0
+
+    def replace(self, executor):
+        '''Replace the current workers (if any) with those of the executor'''
+        self.stop()
+        self.executor = executor
+        self.slots = asyncio.Semaphore(self.workers * self.backlog)
+
+    def start(self, workers):
+        '''
+        Fork the workers (none to run inline) before the event loop runs,
+        and before any other thread starts, as a forked thread's locks would stay held
+        '''
+        self.stop()
+        self.workers = workers
+
+        if workers > 0:
+            self.replace(fork(workers))
+
+    def stop(self):
+        '''Stop the workers once they finish their queued analyses, without waiting for them'''
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def refork(self):
+        '''Fork the workers again off the event loop and replace the current ones with them'''
+        if self.workers > 0:
+            self.replace(await asyncio.get_running_loop().run_in_executor(None, fork, self.workers))
+
+    def restart(self):
+        '''
+        Start forking the workers again after they broke, and return the task
+        (a single one however often it is asked for while forking)
+        '''
+        if self.restarting is None or self.restarting.done():
+            self.restarting = asyncio.create_task(self.refork())
+
+        return self.restarting
+
+    async def submit(self, function, *arguments):
+        '''
+        Run the function on the picklable arguments in a worker (or inline with no workers)
+        and return its result, or None if it was shed
+        '''
+        if self.executor is None:
+            return function(*arguments)
+
+        slots = self.slots
+        try:
+            await asyncio.wait_for(slots.acquire(), self.patience)
+        except asyncio.TimeoutError:
+            self.shed += 1
+            metrics.count('shed_total')
+            return None
+
+        executor = self.executor # as of now, the pool may have been restarted meanwhile
+        self.pending += 1
+        try:
+            if executor is None:
+                return function(*arguments)
+
+            analysis = asyncio.wrap_future(executor.submit(function, *arguments))
+            with metrics.timer('call_seconds', call='worker'):
+                return await asyncio.shield(analysis)
+        except asyncio.CancelledError:
+            if not analysis.cancelled(): # the caller was cancelled, not the analysis
+                raise
+            return function(*arguments)
+        except BrokenProcessPool: # a worker died, fork them again and analyse inline meanwhile
+            if self.executor is executor:
+                logging.getLogger(__name__).warning('Worker pool broke, restarting it')
+                self.restart()
+            return function(*arguments)
+        finally:
+            self.pending -= 1
+            slots.release()
+
+    def stats(self):
+        '''Return the workers, the pending analyses and how many were shed'''
+        return {'workers' : self.workers, 'pending' : self.pending, 'shed' : self.shed}
+
+pool = Pool()
+metrics.gauge('worker_pending', lambda: pool.stats()['pending'])
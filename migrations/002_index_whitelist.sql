@@ -0,0 +1 @@
+create index if not exists whitelist_guild on whitelist(guild);
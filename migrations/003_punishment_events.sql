@@ -0,0 +1,14 @@
+/*
+Append-only log of punishments,
+rolled up into the totals of the punishments table as it is written
+*/
+create table if not exists punishment_events(
+    id integer primary key,
+    guild integer not null,
+    user integer not null,
+    reason text not null,
+    mode text not null,
+    time real not null
+);
+create index if not exists punishment_events_guild on punishment_events(guild, time);
+create index if not exists punishment_events_user on punishment_events(user);
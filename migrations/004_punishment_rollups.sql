@@ -0,0 +1,18 @@
+/*
+Punishment counts per guild, reason and mode in hourly buckets,
+compacted into daily buckets once they are older than a week
+*/
+create table if not exists punishment_rollups(
+    guild integer not null,
+    bucket integer not null, -- start of the bucket (unix time)
+    span integer not null, -- length of the bucket in seconds
+    reason text not null,
+    mode text not null,
+    total integer not null check(total > 0),
+    primary key(guild, bucket, span, reason, mode)
+);
+
+insert into punishment_rollups
+select guild, cast(time / 3600 as integer) * 3600, 3600, reason, mode, count(*)
+from punishment_events
+group by 1, 2, 4, 5;
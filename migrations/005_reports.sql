@@ -0,0 +1,10 @@
+/*
+Reports of scams by domain (or by message if it has none),
+in the order they were first made
+*/
+create table if not exists reports(
+    id integer primary key,
+    key text not null unique,
+    message text not null,
+    count integer not null check(count > 0)
+);
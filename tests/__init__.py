@@ -0,0 +1 @@
+'''Tests, run from the repository root: python -m unittest'''
@@ -0,0 +1,40 @@
+'''An in-process stand-in for the Safe Browsing API'''
+from aiohttp import web
+
+class Stub:
+    '''A local server answering each API method with its handler and recording the requests'''
+    def __init__(self):
+        '''Initialize a stopped server without handlers'''
+        self.handlers = {}
+        self.requests = []
+        self.runner = None
+        self.endpoint = None
+
+    async def start(self):
+        '''Start serving on a free local port and set the endpoint of the API'''
+        app = web.Application()
+        app.router.add_post('/v4/{method}', self.handle)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', 0).start()
+
+        host, port = self.runner.addresses[0][:2]
+        self.endpoint = f'http://{host}:{port}/v4/'
+
+    async def stop(self):
+        '''Stop serving'''
+        await self.runner.cleanup()
+
+    def calls(self, method):
+        '''Return the payloads posted to the method'''
+        return [payload for called, payload in self.requests if called == method]
+
+    async def handle(self, request):
+        '''Record the request and answer it with the handler of its method'''
+        method = request.match_info['method']
+        payload = await request.json()
+        self.requests.append((method, payload))
+
+        response = self.handlers[method](payload)
+        return response if isinstance(response, web.StreamResponse) else web.json_response(response)
@@ -0,0 +1,85 @@
+'''Tests of the Safe Browsing Lookup API client against a local stub'''
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from aiohttp import web
+
+from library import requester
+from library.safebrowsing import SafeBrowsing
+from tests.stub import Stub
+
+METHOD = 'threatMatches:find'
+EVIL = 'https://evil.test/'
+
+def matches(payload, listed=(EVIL,)):
+    '''Return the matches of the listed URLs among the entries of the payload'''
+    return {'matches' : [
+        {'threat' : entry, 'cacheDuration' : '600s'}
+        for entry in payload['threatInfo']['threatEntries'] if entry['url'] in listed
+    ]}
+
+class TestSafeBrowsing(IsolatedAsyncioTestCase):
+    '''Batching, deduplication, caching and failures of the client'''
+    async def asyncSetUp(self):
+        '''Start the stub and point a client at it'''
+        self.stub = Stub()
+        await self.stub.start()
+        self.stub.handlers[METHOD] = matches
+        self.client = SafeBrowsing(f'{self.stub.endpoint}{METHOD}')
+
+    async def asyncTearDown(self):
+        '''Close the session and stop the stub'''
+        await requester.close()
+        await self.stub.stop()
+
+    def entries(self):
+        '''Return the URLs of every request, one list per request'''
+        return [
+            [entry['url'] for entry in payload['threatInfo']['threatEntries']]
+            for payload in self.stub.calls(METHOD)
+        ]
+
+    async def test_batches_and_deduplicates(self):
+        '''Concurrent lookups share one request, each URL sent once'''
+        verdicts = await asyncio.gather(
+            self.client.lookup(['https://a.test/', EVIL], 'key'),
+            self.client.lookup([EVIL, 'https://b.test/'], 'key'),
+            self.client.lookup(['https://a.test/'], 'key')
+        )
+
+        self.assertEqual(verdicts, [True, True, False])
+        self.assertEqual(len(self.entries()), 1)
+        self.assertCountEqual(self.entries()[0], ['https://a.test/', EVIL, 'https://b.test/'])
+
+    async def test_splits_large_batches(self):
+        '''A batch never holds more than the batch size'''
+        self.client.batchsize = 2
+        urls = [f'https://{number}.test/' for number in range(5)]
+
+        self.assertFalse(await self.client.lookup(urls, 'key'))
+        self.assertTrue(all(len(entries) <= 2 for entries in self.entries()))
+        self.assertCountEqual(sum(self.entries(), []), urls)
+
+    async def test_caches_verdicts(self):
+        '''Known verdicts are answered without a request'''
+        await self.client.lookup([EVIL, 'https://a.test/'], 'key')
+
+        self.assertTrue(await self.client.lookup([EVIL], 'key'))
+        self.assertFalse(await self.client.lookup(['https://a.test/'], 'key'))
+        self.assertEqual(len(self.entries()), 1)
+
+    async def test_failure_is_not_cached(self):
+        '''A failed request resolves as unknown and is retried by the next lookup'''
+        self.stub.handlers[METHOD] = lambda payload: web.Response(status=500)
+        self.assertIsNone(await self.client.lookup(['https://a.test/'], 'key'))
+
+        self.stub.handlers[METHOD] = matches
+        self.assertFalse(await self.client.lookup(['https://a.test/'], 'key'))
+        self.assertEqual(len(self.entries()), 2)
+
+    async def test_malformed_response(self):
+        '''A malformed response resolves the batch as unknown instead of leaving it pending'''
+        self.stub.handlers[METHOD] = lambda payload: ['not', 'an', 'object']
+
+        self.assertIsNone(await asyncio.wait_for(self.client.lookup([EVIL], 'key'), 5))
+        self.assertFalse(self.client.pending)
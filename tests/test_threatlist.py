@@ -0,0 +1,133 @@
+'''Tests of the local Safe Browsing hash-prefix database against a local stub'''
+from base64 import b64encode
+from hashlib import sha256
+from tempfile import TemporaryDirectory
+from unittest import IsolatedAsyncioTestCase
+
+from library import requester
+from library.threatlist import PREFIX_SIZE, ThreatDatabase, fullhashes
+from tests.stub import Stub
+
+EVIL = 'https://evil.test/'
+BENIGN = 'https://benign.test/'
+
+def prefix(url):
+    '''Return the prefix of the hash of the host of the URL'''
+    return sha256(url.partition('://')[2].encode()).digest()[:PREFIX_SIZE]
+
+def encode(data):
+    '''Return the data in base64'''
+    return b64encode(data).decode('ascii')
+
+def update(state, added=(), removed=(), stored=(), full=True):
+    '''
+    Return a MALWARE list update adding and removing (by index) prefixes,
+    with the checksum of the list it results in from the stored prefixes
+    '''
+    result = sorted({*(prefix for index, prefix in enumerate(stored) if index not in removed),
+                     *added})
+    return {
+        'threatType' : 'MALWARE',
+        'responseType' : 'FULL_UPDATE' if full else 'PARTIAL_UPDATE',
+        'additions' : [{'rawHashes' : {
+            'prefixSize' : PREFIX_SIZE, 'rawHashes' : encode(b''.join(sorted(added)))
+        }}],
+        'removals' : [{'rawIndices' : {'indices' : list(removed)}}],
+        'newClientState' : state,
+        'checksum' : {'sha256' : encode(sha256(b''.join(result)).digest())}
+    }
+
+class TestThreatDatabase(IsolatedAsyncioTestCase):
+    '''Syncing the lists and confirming their matches'''
+    async def asyncSetUp(self):
+        '''Start the stub and point a database in a temporary directory at it'''
+        self.stub = Stub()
+        await self.stub.start()
+        self.directory = TemporaryDirectory() # pylint: disable=consider-using-with
+        self.database = ThreatDatabase(self.directory.name, self.stub.endpoint)
+        self.database.load()
+
+    async def asyncTearDown(self):
+        '''Close the session and the lists, stop the stub and remove the directory'''
+        await requester.close()
+        await self.stub.stop()
+
+        for prefixes in self.database.lists.values():
+            prefixes.close()
+        self.directory.cleanup()
+
+    async def sync(self, *updates):
+        '''Sync the database with the stub answering the updates'''
+        self.stub.handlers['threatListUpdates:fetch'] = lambda payload: {
+            'listUpdateResponses' : list(updates), 'minimumWaitDuration' : '0s'
+        }
+        self.database.next_sync = 0
+        await self.database.sync('key')
+
+    def states(self):
+        '''Return the client state sent for the MALWARE list by each sync'''
+        return [
+            request['state']
+            for payload in self.stub.calls('threatListUpdates:fetch')
+            for request in payload['listUpdateRequests'] if request['threatType'] == 'MALWARE'
+        ]
+
+    async def test_full_then_partial_update(self):
+        '''A partial update removes prefixes by their index in the sorted list and adds others'''
+        first = sorted(prefix(url) for url in ('https://a.test/', 'https://b.test/', EVIL))
+        await self.sync(update('one', first))
+
+        removed = first.index(prefix('https://b.test/'))
+        await self.sync(update('two', [prefix(BENIGN)], [removed], first, full=False))
+
+        prefixes = self.database.lists['MALWARE']
+        self.assertNotIn(prefix('https://b.test/'), prefixes)
+        for url in ('https://a.test/', EVIL, BENIGN):
+            self.assertIn(prefix(url), prefixes)
+
+        self.assertEqual(self.states(), ['', 'one'])
+        self.assertEqual(self.database.states['MALWARE'], 'two')
+
+    async def test_checksum_mismatch_resets(self):
+        '''A list failing its checksum is kept as it was and asked for in full next time'''
+        await self.sync(update('one', [prefix(EVIL)]))
+        corrupt = update('two', [prefix(BENIGN)], full=False)
+        corrupt['checksum'] = {'sha256' : encode(bytes(32))}
+        await self.sync(corrupt)
+
+        self.assertIn(prefix(EVIL), self.database.lists['MALWARE'])
+        self.assertNotIn(prefix(BENIGN), self.database.lists['MALWARE'])
+        self.assertNotIn('MALWARE', self.database.states)
+
+        await self.sync(update('three', [prefix(EVIL)]))
+        self.assertEqual(self.states(), ['', 'one', ''])
+
+    async def test_confirms_full_hashes(self):
+        '''Only full hashes the API confirms are malicious, and its answers are cached'''
+        evil = fullhashes([EVIL])
+        self.stub.handlers['fullHashes:find'] = lambda payload: {
+            'matches' : [
+                {'threat' : {'hash' : encode(fullhash)}, 'cacheDuration' : '300s'}
+                for fullhash in evil
+                if encode(fullhash[:PREFIX_SIZE]) in
+                    {entry['hash'] for entry in payload['threatInfo']['threatEntries']}
+            ],
+            'negativeCacheDuration' : '300s'
+        }
+        await self.sync(update('one', [prefix(EVIL), prefix(BENIGN)]))
+
+        self.assertTrue(await self.database.lookup([EVIL], 'key'))
+        self.assertFalse(await self.database.lookup([BENIGN], 'key'))
+        self.assertFalse(await self.database.lookup(['https://unlisted.test/'], 'key'))
+        self.assertEqual(len(self.stub.calls('fullHashes:find')), 2)
+
+        self.assertTrue(await self.database.lookup([EVIL], 'key'))
+        self.assertFalse(await self.database.lookup([BENIGN], 'key'))
+        self.assertEqual(len(self.stub.calls('fullHashes:find')), 2)
+
+    async def test_failed_confirmation(self):
+        '''A failed confirmation is unknown rather than clean'''
+        self.stub.handlers['fullHashes:find'] = lambda payload: ['not', 'an', 'object']
+        await self.sync(update('one', [prefix(EVIL)]))
+
+        self.assertIsNone(await self.database.lookup([EVIL], 'key'))